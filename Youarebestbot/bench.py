@@ -0,0 +1,483 @@
+# بنچمارک درون‌پروسه‌ای: آپدیت‌های ساختگی تلگرام رو به /telegram می‌فرسته، upstreamها
+# (codebazan، coinlore، خودرو، holidayapi، دیجی‌کالا، Gemini) و Bot API با stub محلی
+# جایگزین می‌شن و برای هر سناریو updates/sec، p50/p95/p99 و حافظه گزارش می‌شه.
+#
+#   python bench.py                         همه‌ی سناریوها، هر کدوم تو یک پروسه‌ی جدا
+#   python bench.py --scenario prices -n 2000
+#   python bench.py --save baseline.json    ثبت baseline
+#   python bench.py --compare baseline.json مقایسه با baseline
+#   python bench.py --decode [--payloads DIR]   decode قبلی (r.json) در برابر decode فعلی روی
+#                                               payloadهای ضبط‌شده (digikala*.json / cars*.json)
+import os
+import sys
+import json
+import time
+import atexit
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+
+# قبل از import bot: هیچ‌کدوم از این‌ها نباید به شبکه یا دیسک واقعی برن
+os.environ.setdefault("TOKEN", "123456:BENCH")
+os.environ.setdefault("GEMINI_API_KEY", "bench")
+os.environ.setdefault("STATE_BACKEND", "memory")
+os.environ.setdefault("PREFETCH", "0")
+os.environ.setdefault("HTTP_WARMUP", "0")
+os.environ.setdefault("GEMINI_EDIT_INTERVAL", "0.2")
+_BENCH_TMP = tempfile.mkdtemp(prefix="bench-")
+atexit.register(shutil.rmtree, _BENCH_TMP, True)
+os.environ.setdefault("HISTORY_PATH", os.path.join(_BENCH_TMP, "price_history.bin"))
+os.environ.setdefault("HOLIDAY_CACHE_PATH", os.path.join(_BENCH_TMP, "holidays.json"))
+os.environ.setdefault("CHECKPOINT_PATH", os.path.join(_BENCH_TMP, "cache_checkpoint.bin"))
+os.environ.setdefault("TRACE_PATH", os.path.join(_BENCH_TMP, "traces.jsonl"))
+os.environ.setdefault("ALERTS_DB_PATH", os.path.join(_BENCH_TMP, "alerts.sqlite3"))
+# سقف واقعی تلگرام (30 پیام در ثانیه) عدد بنچ رو خراب می‌کنه؛ با --real-limits فعال می‌شه
+if "--real-limits" not in sys.argv:
+    os.environ.setdefault("TG_GLOBAL_RATE", "1000000")
+    os.environ.setdefault("TG_CHAT_RATE", "1000000")
+
+import logging
+
+logging.disable(logging.WARNING)
+
+import httpx
+from telegram.ext import Application
+from telegram.request import BaseRequest
+
+import bot
+
+
+# ---------- upstream stubs ----------
+
+def _fx_payload(n: int = 40) -> dict:
+    names = ["دلار", "یورو", "پوند", "درهم", "لیر", "یوان", "روبل", "دینار"]
+    return {"Result": [{"name": names[i] if i < len(names) else f"ارز {i}", "price": f"{60000 + i * 137:,}"} for i in range(n)]}
+
+def _gold_payload(n: int = 35) -> dict:
+    return {"Result": [{"name": f"سکه {i}", "price": f"{45_000_000 + i * 10_000:,}"} for i in range(n)]}
+
+def _coins_payload() -> dict:
+    syms = ["BTC", "ETH", "USDT", "BNB", "SOL", "XRP", "USDC", "ADA", "DOGE", "TRX", "TON", "DOT", "MATIC", "LTC", "AVAX"]
+    return {"data": [{"name": s.title(), "symbol": s.lower(), "price_usd": f"{random.uniform(0.1, 60000):.2f}"} for s in syms]}
+
+def _cars_payload(n: int = 600) -> dict:
+    brands = ["ایران خودرو", "سایپا", "کرمان موتور", "مدیران خودرو", "بهمن موتور"]
+    return {"cars": [
+        {"brand": brands[i % len(brands)], "name": f"مدل {i}", "market_price": f"{800_000_000 + i * 1_000_000:,}", "factory_price": "-"}
+        for i in range(n)
+    ]}
+
+def _holiday_payload() -> dict:
+    return {"date": "1405/07/25", "is_holiday": False, "events": [{"description": f"مناسبت {i}"} for i in range(4)]}
+
+def _dk_payload(page: int) -> dict:
+    return {"status": 200, "data": {"products": [
+        {
+            "id": page * 1000 + i,
+            "title_fa": f"محصول {page}-{i} با عنوان نسبتاً طولانی برای شبیه‌سازی",
+            "default_variant": {"price": {"selling_price": 1_000_000 + i * 25_000, "discount_percent": i % 4 * 5}},
+            "images": {"main": {"url": ["https://example.invalid/img.jpg"] * 3}},
+            "rating": {"rate": 80, "count": 120},
+        }
+        for i in range(20)
+    ]}}
+
+def _gemini_json() -> dict:
+    return {
+        "candidates": [{"content": {"role": "model", "parts": [{"text": "این یک پاسخ آزمایشی است. " * 8}]}}],
+        "usageMetadata": {"promptTokenCount": 120, "candidatesTokenCount": 60},
+    }
+
+# host → (میانگین تاخیر به ثانیه، نرخ خطا)
+DEFAULT_PROFILE = {
+    "api.codebazan.ir": (0.08, 0.0),
+    "api.coinlore.net": (0.12, 0.0),
+    "car.api-sina-free.workers.dev": (0.25, 0.0),
+    "holidayapi.ir": (0.10, 0.0),
+    "api.digikala.com": (0.30, 0.0),
+    "generativelanguage.googleapis.com": (0.60, 0.0),
+}
+
+class UpstreamStub:
+    def __init__(self, profile: dict):
+        self.profile = profile
+        self.calls = 0
+        self._fx, self._gold, self._coins, self._cars = _fx_payload(), _gold_payload(), _coins_payload(), _cars_payload()
+
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        self.calls += 1
+        host = request.url.host
+        latency, err_rate = self.profile.get(host, (0.05, 0.0))
+        await asyncio.sleep(random.expovariate(1 / latency) if latency > 0 else 0)
+        if random.random() < err_rate:
+            return httpx.Response(502, text="bad gateway")
+
+        path = request.url.path
+        if host == "api.codebazan.ir":
+            return httpx.Response(200, json=self._gold if request.url.params.get("type") == "tala" else self._fx)
+        if host == "api.coinlore.net":
+            return httpx.Response(200, json=self._coins)
+        if host == "car.api-sina-free.workers.dev":
+            return httpx.Response(200, json=self._cars)
+        if host == "holidayapi.ir":
+            return httpx.Response(200, json=_holiday_payload())
+        if host == "api.digikala.com":
+            return httpx.Response(200, json=_dk_payload(int(request.url.params.get("page", 1))))
+        if host == "generativelanguage.googleapis.com":
+            if "streamGenerateContent" in path:
+                return httpx.Response(200, content=self._sse(), headers={"content-type": "text/event-stream"})
+            return httpx.Response(200, json=_gemini_json())
+        return httpx.Response(404)
+
+    async def _sse(self):
+        for i in range(8):
+            await asyncio.sleep(0.03)
+            chunk = {"candidates": [{"content": {"parts": [{"text": f"تکه‌ی {i} از پاسخ. "}]}}]}
+            if i == 7:
+                chunk["usageMetadata"] = {"promptTokenCount": 120, "candidatesTokenCount": 60}
+            yield f"data: {json.dumps(chunk, ensure_ascii=False)}\r\n\r\n".encode()
+
+
+# ---------- Bot API stub ----------
+
+class StubBotRequest(BaseRequest):
+    def __init__(self, latency: float = 0.02):
+        self.latency = latency
+        self.calls = 0
+        self._msg_id = 0
+
+    @property
+    def read_timeout(self):
+        return 5.0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        self.calls += 1
+        endpoint = url.rsplit("/", 1)[-1]
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        params = request_data.parameters if request_data else {}
+        if endpoint == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot",
+                      "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": True}
+        elif endpoint in ("sendMessage", "editMessageText"):
+            self._msg_id += 1
+            result = {
+                "message_id": params.get("message_id") or self._msg_id,
+                "date": int(time.time()),
+                "chat": {"id": params.get("chat_id", 0), "type": "private"},
+                "text": params.get("text", ""),
+            }
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+# ---------- سناریوها ----------
+
+PRICE_TEXTS = ["💵 قیمت ارز", "🥇 طلا و سکه", "₿ ارز دیجیتال", "🚗 قیمت خودرو"]
+
+SCENARIOS = {
+    "prices": {"texts": PRICE_TEXTS},
+    "events": {"texts": ["📅 مناسبت امروز"]},
+    "digikala": {"texts": list(bot.DIGIKALA_CATS), "callbacks": ["dkc_mobile-phone_2", "dkc_apparel_2", "dkc_mobile-phone_3"]},
+    "chat": {"texts": ["سلام، یه سوال دارم", "قیمت دلار چطوره؟", "ممنون"], "chat": True},
+    "mixed": {"texts": PRICE_TEXTS + ["📅 مناسبت امروز", "ℹ️ راهنما"] + list(bot.DIGIKALA_CATS),
+              "callbacks": ["dkc_mobile-phone_2"]},
+    "slow_upstream": {"texts": PRICE_TEXTS, "profile": {
+        "api.codebazan.ir": (1.5, 0.2), "api.coinlore.net": (1.5, 0.2), "car.api-sina-free.workers.dev": (2.0, 0.2),
+    }},
+}
+
+def make_message_update(update_id: int, chat_id: int, text: str) -> dict:
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": int(time.time()), "text": text,
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": "u"},
+    }}
+
+def make_callback_update(update_id: int, chat_id: int, data: str) -> dict:
+    user = {"id": chat_id, "is_bot": False, "first_name": "u"}
+    return {"update_id": update_id, "callback_query": {
+        "id": str(update_id), "from": user, "chat_instance": str(chat_id), "data": data,
+        "message": {"message_id": 1, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}, "text": "x"},
+    }}
+
+def percentile(xs: list, q: float) -> float:
+    if not xs:
+        return 0.0
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(len(xs) * q))]
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+async def run_scenario(name: str, n: int, users: int, concurrency: int, bot_latency: float, trace_memory: bool) -> dict:
+    spec = SCENARIOS[name]
+    profile = {**DEFAULT_PROFILE, **spec.get("profile", {})}
+    upstream = UpstreamStub(profile)
+    done: dict[int, float] = {}
+
+    class TimedApplication(Application):
+        async def process_update(self, update):
+            try:
+                await super().process_update(update)
+            finally:
+                done[getattr(update, "update_id", 0)] = time.perf_counter()
+
+    # handle_text پیام چت رو فقط به coalescer می‌ده؛ برای چت پایان هر پیام لحظه‌ای‌ه که
+    # پاسخ نوبتی که اون پیام توش بوده فرستاده شده، نه برگشتن process_update
+    replied: dict[int, float] = {}
+    if spec.get("chat"):
+        take, turn = bot.chat_coalescer._take, bot.gemini_turn
+        batches: dict[int, list] = {}
+
+        def take_batch(chat_id: int) -> list:
+            batch = batches[chat_id] = take(chat_id)
+            return batch
+
+        async def timed_turn(chat_id, message, text, user_data):
+            try:
+                await turn(chat_id, message, text, user_data)
+            finally:
+                now = time.perf_counter()
+                for m, _ in batches.pop(chat_id, ()):
+                    replied[m.message_id] = now
+
+        bot.chat_coalescer._take = take_batch
+        bot.gemini_turn = timed_turn
+
+    stub = StubBotRequest(bot_latency)
+    bot.application = bot.build_application(request=stub, application_class=TimedApplication)
+    bot._http_transport = httpx.MockTransport(upstream.handler)
+
+    texts, callbacks = spec["texts"], spec.get("callbacks", [])
+    update_id = 0
+    async with bot.lifespan(bot.starlette_app):
+        transport = httpx.ASGITransport(app=bot.starlette_app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            if spec.get("chat"):
+                # ورود به حالت چت خارج از اندازه‌گیری
+                for u in range(users):
+                    update_id += 1
+                    await client.post("/telegram", json=make_message_update(update_id, 10_000 + u, "💬 چت‌بات"))
+                while len(done) < update_id:
+                    await asyncio.sleep(0.01)
+                done.clear()
+
+            if trace_memory:
+                tracemalloc.start()
+            rss0 = rss_mb()
+            sent: dict[int, float] = {}
+            sem = asyncio.Semaphore(concurrency)
+            codes: dict[int, int] = {}
+
+            async def post(uid: int):
+                chat_id = 10_000 + random.randrange(users)
+                if callbacks and random.random() < 0.3:
+                    body = make_callback_update(uid, chat_id, random.choice(callbacks))
+                else:
+                    body = make_message_update(uid, chat_id, random.choice(texts))
+                async with sem:
+                    sent[uid] = time.perf_counter()
+                    r = await client.post("/telegram", json=body)
+                codes[r.status_code] = codes.get(r.status_code, 0) + 1
+                if r.status_code != 200:
+                    sent.pop(uid, None)
+
+            t0 = time.perf_counter()
+            await asyncio.gather(*(post(update_id + i + 1) for i in range(n)))
+            ingest = time.perf_counter() - t0
+            while any(uid not in done for uid in sent) or bot.chat_coalescer.tasks:
+                await asyncio.sleep(0.005)
+            elapsed = time.perf_counter() - t0
+
+            finished = replied if spec.get("chat") else done
+            lat = [finished[uid] - ts for uid, ts in sent.items() if uid in finished]
+            peak = None
+            if trace_memory:
+                peak = tracemalloc.get_traced_memory()[1] / 2**20
+                tracemalloc.stop()
+            result = {
+                "scenario": name,
+                "updates": n,
+                "accepted": len(sent),
+                "status_codes": codes,
+                "updates_per_sec": round(len(sent) / elapsed, 1),
+                "webhook_ingest_per_sec": round(n / ingest, 1),
+                "p50_ms": round(percentile(lat, 0.50) * 1000, 1),
+                "p95_ms": round(percentile(lat, 0.95) * 1000, 1),
+                "p99_ms": round(percentile(lat, 0.99) * 1000, 1),
+                "rss_mb": round(rss_mb(), 1),
+                "rss_delta_mb": round(rss_mb() - rss0, 1),
+                "upstream_calls": upstream.calls,
+                "bot_api_calls": stub.calls,
+            }
+            if peak is not None:
+                result["tracemalloc_peak_mb"] = round(peak, 2)
+            return result
+
+def print_table(results: list, baseline: dict | None = None):
+    cols = ["updates_per_sec", "p50_ms", "p95_ms", "p99_ms", "rss_mb", "upstream_calls"]
+    print(f"{'scenario':<15}" + "".join(f"{c:>18}" for c in cols))
+    for r in results:
+        row = f"{r['scenario']:<15}"
+        base = (baseline or {}).get(r["scenario"])
+        for c in cols:
+            v = r.get(c)
+            cell = f"{v}"
+            if base and isinstance(v, (int, float)) and base.get(c):
+                cell += f" ({(v - base[c]) / base[c] * 100:+.0f}%)"
+            row += f"{cell:>18}"
+        print(row)
+
+# ---------- decode benchmark ----------
+
+def _dk_recorded_like(page: int, n: int = 60) -> dict:
+    # نزدیک به جواب واقعی جستجو: فیلترها قبل از products و هر محصول با تصویر و مشخصات
+    return {"status": 200, "data": {
+        "filters": {f"f{i}": {"title": f"فیلتر {i}", "options": [{"id": j, "title": f"گزینه {j}"} for j in range(30)]}
+                    for i in range(12)},
+        "products": [
+            {
+                "id": page * 1000 + i,
+                "title_fa": f"محصول {page}-{i} با عنوان نسبتاً طولانی برای شبیه‌سازی",
+                "title_en": f"Product {page}-{i}",
+                "default_variant": {"id": i, "price": {"selling_price": 1_000_000 + i * 25_000, "rrp_price": 1_200_000,
+                                                       "discount_percent": i % 4 * 5}},
+                "images": {"main": {"url": [f"https://example.invalid/{i}/{k}.jpg" for k in range(4)]},
+                           "list": [{"url": [f"https://example.invalid/{i}/l{k}.jpg"]} for k in range(6)]},
+                "specifications": [{"title": f"ویژگی {k}", "values": [f"مقدار {k}"]} for k in range(10)],
+                "rating": {"rate": 80, "count": 120},
+            }
+            for i in range(n)
+        ],
+        "pager": {"current_page": page, "total_pages": 100},
+    }}
+
+def _load_payloads(directory: str | None) -> dict[str, list[bytes]]:
+    out = {"digikala": [], "cars": []}
+    if directory:
+        for fn in sorted(os.listdir(directory)):
+            kind = "cars" if fn.startswith("cars") else "digikala" if fn.startswith(("digikala", "dk")) else None
+            if kind and fn.endswith(".json"):
+                with open(os.path.join(directory, fn), "rb") as f:
+                    out[kind].append(f.read())
+    if not out["digikala"]:
+        out["digikala"] = [json.dumps(_dk_recorded_like(p), ensure_ascii=False).encode() for p in range(1, 4)]
+    if not out["cars"]:
+        out["cars"] = [json.dumps(_cars_payload(2500), ensure_ascii=False).encode()]
+    return out
+
+DECODE_PATHS = {
+    "digikala": {
+        "baseline": lambda b: bot.dk_slim_products(bot.dk_extract_products(json.loads(b.decode("utf-8")))),
+        "current": lambda b: bot.dk_slim_products(bot.dk_decode_products(b)),
+    },
+    "cars": {
+        "baseline": lambda b: json.loads(b.decode("utf-8")),
+        "current": bot.json_loads,
+    },
+}
+
+def run_decode_bench(directory: str | None, reps: int):
+    payloads = _load_payloads(directory)
+    print(f"{'payload':<10}{'path':<10}{'kb':>10}{'ms/op':>10}{'peak_kb':>10}")
+    for kind, bodies in payloads.items():
+        kb = sum(len(b) for b in bodies) / len(bodies) / 1024
+        for path, fn in DECODE_PATHS[kind].items():
+            t0 = time.perf_counter()
+            for _ in range(reps):
+                for b in bodies:
+                    fn(b)
+            ms = (time.perf_counter() - t0) / (reps * len(bodies)) * 1000
+            tracemalloc.start()
+            for b in bodies:
+                fn(b)
+            peak = tracemalloc.get_traced_memory()[1] / 1024
+            tracemalloc.stop()
+            print(f"{kind:<10}{path:<10}{kb:>10.0f}{ms:>10.2f}{peak:>10.0f}")
+
+def run_checks():
+    # رگرسیون‌های کوچیک روی ورودی‌هایی که بنچ به‌طور عادی بهشون نمی‌رسه
+    t = time.time() - 3 * 86400
+    for i, v in enumerate((100.0, 110.0, 105.0)):
+        bot.record_price("check:stale", v, t + i * bot.HISTORY_STEP)
+    assert bot.trend_text("check:stale") == " ▼4.5%", bot.trend_text("check:stale")
+    bot.price_history.pop("check:stale", None)
+    print("checks ok")
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark starlette_app with synthetic Telegram updates.")
+    ap.add_argument("--scenario", choices=sorted(SCENARIOS), action="append")
+    ap.add_argument("-n", "--updates", type=int, default=1000)
+    ap.add_argument("--users", type=int, default=200)
+    ap.add_argument("--concurrency", type=int, default=50)
+    ap.add_argument("--bot-latency", type=float, default=0.02, help="Bot API stub latency (s)")
+    ap.add_argument("--trace-memory", action="store_true", help="tracemalloc peak (slower)")
+    ap.add_argument("--real-limits", action="store_true", help="keep Telegram rate limits")
+    ap.add_argument("--json", action="store_true", help="print raw JSON results")
+    ap.add_argument("--save", metavar="FILE")
+    ap.add_argument("--compare", metavar="FILE")
+    ap.add_argument("--decode", action="store_true", help="benchmark JSON decoding paths instead")
+    ap.add_argument("--payloads", metavar="DIR", help="recorded payloads for --decode")
+    ap.add_argument("--check", action="store_true", help="run regression checks and exit")
+    args = ap.parse_args()
+
+    if args.check:
+        run_checks()
+        return
+
+    if args.decode:
+        run_decode_bench(args.payloads, max(1, args.updates // 50))
+        return
+
+    names = args.scenario or sorted(SCENARIOS)
+    results = []
+    if len(names) == 1:
+        results.append(asyncio.run(run_scenario(
+            names[0], args.updates, args.users, args.concurrency, args.bot_latency, args.trace_memory
+        )))
+    else:
+        # هر سناریو تو پروسه‌ی جدا تا کش و حافظه‌ی سناریوی قبلی روی عددها اثر نذاره
+        for name in names:
+            cmd = [sys.executable, os.path.abspath(__file__), "--scenario", name, "--json",
+                   "-n", str(args.updates), "--users", str(args.users), "--concurrency", str(args.concurrency),
+                   "--bot-latency", str(args.bot_latency)]
+            if args.trace_memory:
+                cmd.append("--trace-memory")
+            if args.real_limits:
+                cmd.append("--real-limits")
+            out = subprocess.run(cmd, capture_output=True, text=True, check=True).stdout
+            results.extend(json.loads(out))
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False))
+        return
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = {r["scenario"]: r for r in json.load(f)}
+    print_table(results, baseline)
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -1,32 +1,36 @@
+from __future__ import annotations
+
 import os
 import re
 import json
+import math
+import mmap
+import time
+import struct
+import random
+import tempfile
+import asyncio
 import logging
+import sqlite3
+import heapq
+import bisect
+import functools
+import itertools
+import threading
+import contextvars
+from array import array
+from collections import deque, OrderedDict
 from contextlib import asynccontextmanager
-from datetime import datetime, timezone
-
-import httpx
-from telegram import (
-    Update,
-    ReplyKeyboardMarkup,
-    InlineKeyboardMarkup,
-    InlineKeyboardButton,
-)
-from telegram.constants import ChatAction
-from telegram.ext import (
-    ApplicationBuilder,
-    CommandHandler,
-    MessageHandler,
-    CallbackQueryHandler,
-    ContextTypes,
-    filters,
-)
+from datetime import datetime, timezone, timedelta, time as dtime
 
+import jdatetime
+
+# telegram، telegram.ext و httpx (حدود ۲۲۰ms) اینجا import نمی‌شن: uvicorn پورت رو فقط با
+# starlette باز می‌کنه و load_telegram() اول boot اسم‌ها رو global می‌کنه (پایین فایل).
 from starlette.applications import Starlette
 from starlette.requests import Request
-from starlette.responses import Response, PlainTextResponse
+from starlette.responses import Response, PlainTextResponse, JSONResponse
 from starlette.routing import Route
-import uvicorn
 
 
 TOKEN = os.getenv("TOKEN")
@@ -40,42 +44,43 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("multi-bot")
 
 
-main_keyboard = ReplyKeyboardMarkup(
-    [
-        ["🚗 قیمت خودرو", "💵 قیمت ارز"],
-        ["🥇 طلا و سکه", "₿ ارز دیجیتال"],
-        ["📅 مناسبت امروز", "🛒 دیجی‌کالا"],
-        ["💬 چت‌بات", "ℹ️ راهنما"],
-    ],
-    resize_keyboard=True,
-)
+# چیدمان کیبوردها؛ ReplyKeyboardMarkup‌ها رو load_telegram() می‌سازه
+MAIN_KEYBOARD = [
+    ["🚗 قیمت خودرو", "💵 قیمت ارز"],
+    ["🥇 طلا و سکه", "₿ ارز دیجیتال"],
+    ["📅 مناسبت امروز", "🛒 دیجی‌کالا"],
+    ["💬 چت‌بات", "ℹ️ راهنما"],
+    ["🔎 جستجوی خودرو"],
+]
 
-digikala_menu_keyboard = ReplyKeyboardMarkup(
-    [
-        ["📱 موبایل دیجی‌کالا", "💻 لپ‌تاپ دیجی‌کالا"],
-        ["👕 پوشاک دیجی‌کالا", "🔎 سرچ دستی دیجی‌کالا"],
-        ["⬅️ بازگشت", "❌ لغو"],
-    ],
-    resize_keyboard=True,
-)
+DIGIKALA_MENU_KEYBOARD = [
+    ["📱 موبایل دیجی‌کالا", "💻 لپ‌تاپ دیجی‌کالا"],
+    ["👕 پوشاک دیجی‌کالا", "🔎 سرچ دستی دیجی‌کالا"],
+    ["🌐 جستجو در همه‌ی دسته‌ها"],
+    ["⬅️ بازگشت", "❌ لغو"],
+]
 
-chat_keyboard = ReplyKeyboardMarkup(
-    [
-        ["🛑 پایان چت", "⬅️ بازگشت"],
-        ["ℹ️ راهنما"],
-    ],
-    resize_keyboard=True,
-)
+CHAT_KEYBOARD = [
+    ["🛑 پایان چت", "⬅️ بازگشت"],
+    ["ℹ️ راهنما"],
+]
+
+main_keyboard = digikala_menu_keyboard = chat_keyboard = None
 
 HELP_TEXT = (
     "🧩 ربات چندکاره\n\n"
     "🚗 قیمت خودرو: لیست قیمت خودروها\n"
+    "🔎 جستجوی خودرو: جستجو با برند یا مدل (یا تو هر چت: @اسم‌ربات + نام خودرو)\n"
     "💵 قیمت ارز: نرخ ارزها\n"
     "🥇 طلا و سکه: قیمت طلا و سکه\n"
     "₿ ارز دیجیتال: قیمت رمزارزها\n"
     "📅 مناسبت امروز: مناسبت‌ها و تعطیلی رسمی\n\n"
+    "🔔 هشدار قیمت:\n"
+    "• /alert دلار > 65000 یا /alert BTC < 50000\n"
+    "• /alerts لیست هشدارها، /unalert شماره برای حذف\n\n"
     "🛒 دیجی‌کالا:\n"
     "• «🛒 دیجی‌کالا» → انتخاب دسته یا سرچ دستی\n"
+    "• «🌐 جستجو در همه‌ی دسته‌ها»: یک لیست مرتب‌شده بر اساس قیمت یا تخفیف\n"
     "• نتایج: فقط متن + دکمه قبلی/بعدی\n\n"
     "💬 چت‌بات:\n"
     "• شروع گفتگو آزاد\n"
@@ -92,6 +97,15 @@ COINLORE = "https://api.coinlore.net/api/tickers/?start=0&limit=15"
 
 HOLIDAY_URL = "https://holidayapi.ir/jalali/{y}/{m}/{d}"
 
+# snapshotهای upstream که فیچرها بهشون وابسته‌ان
+SNAPSHOT_URLS = {
+    "fx": CODEBAZAN_ARZ_URL,
+    "gold": CODEBAZAN_TALA_URL,
+    "coins": COINLORE,
+    "cars": CAR_ALL_URL,
+}
+SNAPSHOT_NAMES = {url: name for name, url in SNAPSHOT_URLS.items()}
+
 # Digikala
 DIGIKALA_BASE = "https://api.digikala.com/v1"
 DK_SEARCH = f"{DIGIKALA_BASE}/search/"
@@ -104,56 +118,799 @@ DIGIKALA_CATS = {
 
 # Gemini REST
 GEMINI_URL = lambda model: f"https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent"
-
-_http: httpx.AsyncClient | None = None
-
-def _http_client() -> httpx.AsyncClient:
-    global _http
-    if _http is None:
-        _http = httpx.AsyncClient(
-            timeout=httpx.Timeout(25.0, connect=10.0),
+GEMINI_STREAM_URL = lambda model: f"https://generativelanguage.googleapis.com/v1beta/models/{model}:streamGenerateContent?alt=sse"
+GEMINI_STREAM = os.getenv("GEMINI_STREAM", "1") != "0"
+# فاصله‌ی بین edit_message_text ها (محدودیت ادیت تلگرام)
+GEMINI_EDIT_INTERVAL = float(os.getenv("GEMINI_EDIT_INTERVAL", "1.2"))
+# سقف تقریبی توکن تاریخچه؛ نوبت‌های قدیمی‌تر خلاصه می‌شن
+GEMINI_HISTORY_TOKENS = int(os.getenv("GEMINI_HISTORY_TOKENS", "1500"))
+GEMINI_SYSTEM_PROMPT = "تو یک دستیار فارسیِ مودب و کوتاه‌گو هستی. پاسخ‌ها را روشن، کاربردی و خلاصه بده."
+
+# متریک‌ها به فرمت متنی Prometheus روی /metrics. شمارنده‌ها int ساده‌ان (همه روی یک
+# event loop اجرا می‌شن، پس قفل لازم نیست) و bucketها موقع ساخت هر سری از قبل رزرو می‌شن.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 25.0)
+
+class Counter:
+    def __init__(self, name: str, doc: str, label: str):
+        self.name, self.doc, self.label = name, doc, label
+        self.series: dict[str, float] = {}
+
+    def inc(self, label: str, value: float = 1):
+        self.series[label] = self.series.get(label, 0) + value
+
+    def render(self, out: list):
+        out.append(f"# HELP {self.name} {self.doc}\n# TYPE {self.name} counter")
+        for lv, v in self.series.items():
+            out.append(f'{self.name}{{{self.label}="{lv}"}} {v}')
+
+class Histogram:
+    def __init__(self, name: str, doc: str, label: str, buckets: tuple = LATENCY_BUCKETS):
+        self.name, self.doc, self.label, self.buckets = name, doc, label, buckets
+        # هر سری: [شمارش هر bucket..., +Inf, sum, count]
+        self.series: dict[str, list] = {}
+
+    def observe(self, value: float, label: str):
+        s = self.series.get(label)
+        if s is None:
+            s = self.series[label] = [0] * (len(self.buckets) + 3)
+        s[bisect.bisect_left(self.buckets, value)] += 1
+        s[-2] += value
+        s[-1] += 1
+
+    def render(self, out: list):
+        out.append(f"# HELP {self.name} {self.doc}\n# TYPE {self.name} histogram")
+        for lv, s in self.series.items():
+            acc = 0
+            for le, n in zip(self.buckets, s):
+                acc += n
+                out.append(f'{self.name}_bucket{{{self.label}="{lv}",le="{le}"}} {acc}')
+            out.append(f'{self.name}_bucket{{{self.label}="{lv}",le="+Inf"}} {s[-1]}')
+            out.append(f'{self.name}_sum{{{self.label}="{lv}"}} {s[-2]:.6f}')
+            out.append(f'{self.name}_count{{{self.label}="{lv}"}} {s[-1]}')
+
+handler_seconds = Histogram("bot_handler_seconds", "Handler latency per branch.", "handler")
+upstream_seconds = Histogram("bot_upstream_seconds", "Upstream HTTP latency.", "upstream")
+upstream_requests = Counter("bot_upstream_requests_total", "Upstream HTTP requests.", "upstream")
+upstream_errors = Counter("bot_upstream_errors_total", "Failed upstream HTTP requests.", "upstream")
+gemini_tokens = Counter("bot_gemini_tokens_total", "Gemini tokens from usageMetadata.", "kind")
+
+_upstream_labels: dict[str, str] = {}
+
+def upstream_label(url: str) -> str:
+    # host + path، با عددها جمع‌شده تا مسیرهایی مثل تاریخ holiday سری جدا نسازن
+    lbl = _upstream_labels.get(url)
+    if lbl is None:
+        u = httpx.URL(url)
+        lbl = u.host + re.sub(r"\d+", "N", u.path)
+        if len(_upstream_labels) < 1000:
+            _upstream_labels[url] = lbl
+    return lbl
+
+def observe_upstream(url: str, t0: float, ok: bool):
+    lbl = upstream_label(url)
+    upstream_seconds.observe(time.monotonic() - t0, lbl)
+    upstream_requests.inc(lbl)
+    if not ok:
+        upstream_errors.inc(lbl)
+    trace_span("http", lbl, t0, ok)
+
+# Trace آپدیت‌های کند: timed() برای هر آپدیت یک Trace تو contextvar می‌ذاره و درخواست‌های
+# upstream، Bot API و مرحله‌های @traced به‌عنوان span بهش اضافه می‌شن. فقط آپدیت‌هایی که از
+# TRACE_SLOW_MS رد بشن (یا تو نمونه‌ی TRACE_SAMPLE بیفتن) به صورت JSONL نوشته می‌شن. لحظه‌ای که
+# آپدیت از آستانه رد می‌شه زنجیره‌ی await تسک هندلر عکس‌برداری می‌شه تا معلوم باشه کجا گیر کرده.
+TRACE_PATH = os.getenv("TRACE_PATH", "traces.jsonl")
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "2000"))
+TRACE_SAMPLE = float(os.getenv("TRACE_SAMPLE", "0.01"))
+TRACE_MAX_BYTES = int(os.getenv("TRACE_MAX_BYTES", str(5 * 2**20)))
+TRACE_MAX_SPANS = 200
+
+_current_trace: contextvars.ContextVar = contextvars.ContextVar("trace", default=None)
+trace_stats = {"traced": 0, "slow": 0, "sampled": 0, "write_errors": 0, "dropped": 0}
+TRACE_QUEUE_MAX = 1000
+_trace_pending: list[bytes] = []
+_trace_writer: asyncio.Task | None = None
+
+class Trace:
+    __slots__ = ("label", "update_id", "chat_id", "t0", "spans", "stack", "tasks", "done", "timer")
+
+    def __init__(self, label: str, update_id, chat_id):
+        self.label, self.update_id, self.chat_id = label, update_id, chat_id
+        self.t0 = time.monotonic()
+        self.spans: list[tuple] = []
+        self.stack: list[str] | None = None
+        self.tasks = 0
+        self.done = False
+        self.timer = None
+
+def trace_span(kind: str, name: str, t0: float, ok: bool = True):
+    tr = _current_trace.get()
+    # tr.done: تسک‌های مشترکی (single-flight) که بعد از تموم شدن آپدیت هنوز زنده‌ان
+    if tr is not None and not tr.done and len(tr.spans) < TRACE_MAX_SPANS:
+        tr.spans.append((kind, name, t0 - tr.t0, time.monotonic() - t0, ok))
+
+def traced(fn):
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        t0 = time.monotonic()
+        ok = False
+        try:
+            result = await fn(*args, **kwargs)
+            ok = True
+            return result
+        finally:
+            trace_span("step", fn.__name__, t0, ok)
+    return wrapper
+
+def _await_chain(task: asyncio.Task) -> list[str]:
+    out = []
+    obj = task.get_coro()
+    while obj is not None and len(out) < 40:
+        if isinstance(obj, asyncio.Task):
+            obj = obj.get_coro()
+            continue
+        frame = getattr(obj, "cr_frame", None) or getattr(obj, "gi_frame", None) or getattr(obj, "ag_frame", None)
+        if frame is None:
+            if isinstance(obj, asyncio.Future):
+                out.append(f"<{type(obj).__name__}>")
+            break
+        out.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno} {frame.f_code.co_name}")
+        obj = getattr(obj, "cr_await", None) or getattr(obj, "gi_yieldfrom", None) or getattr(obj, "ag_await", None)
+    return out
+
+def _trace_snapshot(tr: Trace, task: asyncio.Task):
+    if not tr.done:
+        tr.stack = _await_chain(task)
+        tr.tasks = len(asyncio.all_tasks())
+
+def trace_begin(label: str, update_id, chat_id) -> tuple | None:
+    if not TRACE_PATH:
+        return None
+    tr = Trace(label, update_id, chat_id)
+    task = asyncio.current_task()
+    if task is not None:
+        tr.timer = asyncio.get_running_loop().call_later(TRACE_SLOW_MS / 1000, _trace_snapshot, tr, task)
+    trace_stats["traced"] += 1
+    return tr, _current_trace.set(tr)
+
+def trace_end(handle: tuple | None, ok: bool):
+    if handle is None:
+        return
+    tr, token = handle
+    _current_trace.reset(token)
+    tr.done = True
+    if tr.timer is not None:
+        tr.timer.cancel()
+    ms = (time.monotonic() - tr.t0) * 1000
+    if ms >= TRACE_SLOW_MS:
+        reason = "slow"
+    elif random.random() < TRACE_SAMPLE:
+        reason = "sampled"
+    else:
+        return
+    trace_stats[reason] += 1
+    rec = {
+        "ts": round(time.time(), 3), "handler": tr.label, "update_id": tr.update_id, "chat_id": tr.chat_id,
+        "ms": round(ms, 1), "ok": ok, "reason": reason,
+        "spans": [
+            {"kind": k, "name": n, "at_ms": round(at * 1000, 1), "ms": round(d * 1000, 1), "ok": sok}
+            for k, n, at, d, sok in tr.spans
+        ],
+    }
+    if tr.stack is not None:
+        rec["stack"] = tr.stack
+        rec["tasks"] = tr.tasks
+    queue_trace(json_dumps(rec) + b"\n")
+
+def queue_trace(line: bytes):
+    # نوشتن فایل روی event loop نیست: خط‌ها جمع می‌شن و یک تسک تکی با to_thread می‌نویسه‌شون
+    global _trace_writer
+    if len(_trace_pending) >= TRACE_QUEUE_MAX:
+        trace_stats["dropped"] += 1
+        return
+    _trace_pending.append(line)
+    if _trace_writer is None or _trace_writer.done():
+        _trace_writer = asyncio.create_task(_trace_flush())
+
+async def _trace_flush():
+    while _trace_pending:
+        batch = b"".join(_trace_pending)
+        _trace_pending.clear()
+        try:
+            await asyncio.to_thread(write_trace, batch)
+        except OSError as e:
+            trace_stats["write_errors"] += 1
+            logger.warning("Trace write failed: %s", e)
+
+async def flush_traces():
+    if _trace_writer is not None and not _trace_writer.done():
+        await _trace_writer
+
+def write_trace(line: bytes, path: str = TRACE_PATH):
+    # یک خط کوچک append؛ وقتی فایل از سقف رد شد یک نسخه‌ی .1 نگه داشته می‌شه
+    with open(path, "ab") as f:
+        f.write(line)
+        size = f.tell()
+    if size > TRACE_MAX_BYTES:
+        os.replace(path, path + ".1")
+
+def record_gemini_usage(data):
+    usage = data.get("usageMetadata") if isinstance(data, dict) else None
+    if isinstance(usage, dict):
+        gemini_tokens.inc("prompt", usage.get("promptTokenCount") or 0)
+        gemini_tokens.inc("output", usage.get("candidatesTokenCount") or 0)
+
+# برای هر upstream یک pool جدا با limit، timeout و header خودش؛ یک host کند (مثلاً Gemini
+# با stream طولانی) دیگه connectionهای بقیه رو اشغال نمی‌کنه. HTTP/2 فقط وقتی h2 نصب باشه.
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+HTTP_DEFAULT_HEADERS = {"User-Agent": "Mozilla/5.0 (TelegramBot)", "Accept": "application/json,text/plain,*/*"}
+HTTP_DEFAULT_POOL = {"max": 10, "keepalive": 5, "expiry": 30.0, "timeout": 25.0, "connect": 10.0, "http2": False}
+HTTP_POOLS = {
+    "api.digikala.com": {"max": 20, "keepalive": 10, "expiry": 60.0, "timeout": 15.0, "http2": True,
+                         "headers": {"Referer": "https://www.digikala.com/"}},
+    "generativelanguage.googleapis.com": {"max": 16, "keepalive": 8, "expiry": 120.0, "timeout": 60.0, "http2": True},
+    "api.codebazan.ir": {"max": 4, "keepalive": 2, "expiry": 90.0, "timeout": 15.0},
+    "api.coinlore.net": {"max": 4, "keepalive": 2, "expiry": 90.0, "timeout": 15.0, "http2": True},
+    "car.api-sina-free.workers.dev": {"max": 4, "keepalive": 2, "expiry": 90.0, "timeout": 20.0, "http2": True},
+    "holidayapi.ir": {"max": 8, "keepalive": 4, "expiry": 30.0, "timeout": 10.0},
+}
+HTTP_WARMUP = os.getenv("HTTP_WARMUP", "1") != "0"
+HTTP_WARMUP_TIMEOUT = float(os.getenv("HTTP_WARMUP_TIMEOUT", "4"))
+
+_http_clients: dict[str, httpx.AsyncClient] = {}
+# bench یک MockTransport اینجا می‌ذاره
+_http_transport: httpx.AsyncBaseTransport | None = None
+
+def _http_client(url: str) -> httpx.AsyncClient:
+    host = httpx.URL(url).host
+    c = _http_clients.get(host)
+    if c is None:
+        cfg = {**HTTP_DEFAULT_POOL, **HTTP_POOLS.get(host, {})}
+        c = _http_clients[host] = httpx.AsyncClient(
+            timeout=httpx.Timeout(cfg["timeout"], connect=cfg["connect"]),
+            limits=httpx.Limits(
+                max_connections=cfg["max"], max_keepalive_connections=cfg["keepalive"], keepalive_expiry=cfg["expiry"]
+            ),
+            http2=cfg["http2"] and HTTP2_AVAILABLE,
+            transport=_http_transport,
             follow_redirects=True,
-            headers={
-                "User-Agent": "Mozilla/5.0 (TelegramBot)",
-                "Accept": "application/json,text/plain,*/*",
-                "Referer": "https://www.digikala.com/",
-            },
+            headers={**HTTP_DEFAULT_HEADERS, **cfg.get("headers", {})},
         )
-    return _http
+    return c
+
+async def _warm_host(host: str, n: int):
+    # فقط برای باز کردن TCP+TLS؛ status مهم نیست و تو metrics/breaker حساب نمی‌شه
+    c = _http_client(f"https://{host}/")
+    async def one():
+        try:
+            await c.head(f"https://{host}/", timeout=HTTP_WARMUP_TIMEOUT)
+        except Exception as e:
+            logger.info("Warm-up %s failed: %s", host, e)
+    await asyncio.gather(*(one() for _ in range(n)))
 
-async def http_get_json(url: str, params: dict | None = None, headers: dict | None = None):
-    c = _http_client()
+async def warm_http_pools():
+    if not HTTP_WARMUP:
+        return
+    t0 = time.monotonic()
+    # برای HTTP/2 یک connection کافیه؛ برای HTTP/1.1 دوتا تا اولین درخواست‌های موازی منتظر نمونن
+    jobs = [_warm_host(h, 1 if cfg.get("http2") and HTTP2_AVAILABLE else 2) for h, cfg in HTTP_POOLS.items()]
     try:
-        r = await c.get(url, params=params, headers=headers)
-        r.raise_for_status()
-        return r.json()
+        await asyncio.wait_for(asyncio.gather(*jobs), HTTP_WARMUP_TIMEOUT + 1)
+    except asyncio.TimeoutError:
+        logger.warning("HTTP warm-up did not finish in time")
+    logger.info("HTTP pools warmed in %.2fs", time.monotonic() - t0)
+
+def http_pool_stats() -> dict:
+    out = {}
+    for host, c in _http_clients.items():
+        # httpx شمارنده‌ی عمومی نداره؛ از httpcore pool خونده می‌شه (اگه transport واقعی باشه)
+        pool = getattr(getattr(c, "_transport", None), "_pool", None)
+        conns = list(getattr(pool, "connections", []) or [])
+        reqs = list(getattr(pool, "_requests", []) or [])
+        idle = sum(1 for x in conns if x.is_idle())
+        out[host] = {
+            "connections": len(conns),
+            "idle": idle,
+            "active": len(conns) - idle,
+            "requests": len(reqs),
+            "waiting": sum(1 for r in reqs if getattr(r, "connection", None) is None),
+            "max": getattr(pool, "_max_connections", None),
+        }
+    return out
+
+async def close_http_pools():
+    clients = list(_http_clients.values())
+    _http_clients.clear()
+    await asyncio.gather(*(c.aclose() for c in clients), return_exceptions=True)
+
+# Circuit breaker برای هر host: بعد از چند خطای پشت‌سرهم باز می‌شه و سریع fail می‌کنه،
+# بعد از cooldown یک درخواست آزمایشی (half-open) رد می‌شه.
+BREAKER_THRESHOLD = int(os.getenv("BREAKER_THRESHOLD", "5"))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "30"))
+# Hedging برای GET: اگه جواب تا p95 اون host نیومد، یک درخواست دوم هم می‌ره
+HTTP_HEDGE = os.getenv("HTTP_HEDGE", "1") != "0"
+HEDGE_MIN_SAMPLES = 20
+HEDGE_MIN_DELAY = 0.05
+
+class CircuitBreaker:
+    __slots__ = ("state", "failures", "opened_at", "probing")
+
+    def __init__(self):
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < BREAKER_COOLDOWN:
+                return False
+            self.state = "half_open"
+            self.probing = False
+        if self.probing:
+            return False
+        self.probing = True
+        return True
+
+    def success(self):
+        self.state = "closed"
+        self.failures = 0
+        self.probing = False
+
+    def failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.state == "half_open" or self.failures >= BREAKER_THRESHOLD:
+            if self.state != "open":
+                logger.warning("Circuit opened (%d failures)", self.failures)
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def release(self):
+        # probe بدون نتیجه تموم شد (مثلاً CancelledError)؛ دفعه‌ی بعد دوباره probe می‌زنیم
+        self.probing = False
+
+_breakers: dict[str, CircuitBreaker] = {}
+_latencies: dict[str, deque] = {}
+hedge_stats = {"hedged": 0, "hedge_wins": 0}
+
+def _breaker(host: str) -> CircuitBreaker:
+    b = _breakers.get(host)
+    if b is None:
+        b = _breakers[host] = CircuitBreaker()
+    return b
+
+def _record_latency(host: str, seconds: float):
+    q = _latencies.get(host)
+    if q is None:
+        q = _latencies[host] = deque(maxlen=200)
+    q.append(seconds)
+
+def host_p95(host: str) -> float | None:
+    q = _latencies.get(host)
+    if not q or len(q) < HEDGE_MIN_SAMPLES:
+        return None
+    xs = sorted(q)
+    return xs[int(len(xs) * 0.95) - 1]
+
+def _circuit_open_error(url: str) -> dict:
+    return {"_error": True, "status_code": None, "url": url, "body": "circuit open", "circuit_open": True}
+
+def _is_host_failure(e: Exception) -> bool:
+    # 4xx یعنی host زنده‌ست؛ فقط 5xx و خطای شبکه/timeout شمرده می‌شه
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response is not None and e.response.status_code >= 500
+    return True
+
+# decode روی bytes خام: orjson (اگه نصب باشه) هم سریع‌تره هم کلیدها رو cache می‌کنه؛
+# جایی که فقط بخش کوچکی از payload لازمه (دیجی‌کالا) decoder اختصاصی پاس داده می‌شه.
+try:
+    import orjson
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    json_loads = json.loads
+    json_dumps = lambda v: json.dumps(v, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+async def _get_once(url: str, params: dict | None, headers: dict | None, decode=None):
+    r = await _http_client(url).get(url, params=params, headers=headers)
+    r.raise_for_status()
+    return (decode or json_loads)(r.content)
+
+async def _hedged_get(host: str, url: str, params: dict | None, headers: dict | None, decode=None):
+    delay = host_p95(host) if HTTP_HEDGE else None
+    first = asyncio.create_task(_get_once(url, params, headers, decode))
+    tasks = {first}
+    err = None
+    try:
+        if delay is not None:
+            done, _ = await asyncio.wait(tasks, timeout=max(delay, HEDGE_MIN_DELAY))
+            if not done:
+                hedge_stats["hedged"] += 1
+                tasks.add(asyncio.create_task(_get_once(url, params, headers, decode)))
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for t in done:
+                if t.exception() is None:
+                    if t is not first:
+                        hedge_stats["hedge_wins"] += 1
+                    return t.result()
+                err = t.exception()
+        raise err
+    finally:
+        for t in tasks:
+            t.cancel()
+
+async def http_get_json(
+    url: str, params: dict | None = None, headers: dict | None = None, deadline: float | None = None, decode=None
+):
+    host = httpx.URL(url).host
+    br = _breaker(host)
+    if not br.allow():
+        return _circuit_open_error(url)
+    t0 = time.monotonic()
+    try:
+        data = await asyncio.wait_for(_hedged_get(host, url, params, headers, decode), deadline)
+        br.success()
+        _record_latency(host, time.monotonic() - t0)
+        observe_upstream(url, t0, True)
+        return data
     except httpx.HTTPStatusError as e:
+        br.failure() if _is_host_failure(e) else br.success()
+        observe_upstream(url, t0, False)
         status = e.response.status_code if e.response else None
         body = ""
         try:
             body = e.response.text[:800] if e.response else ""
         except Exception:
             pass
-        return {"_error": True, "status_code": status, "url": url, "body": body}
+        retry_after = e.response.headers.get("Retry-After") if e.response else None
+        return {"_error": True, "status_code": status, "url": url, "body": body, "retry_after": retry_after}
+    except asyncio.TimeoutError:
+        br.failure()
+        observe_upstream(url, t0, False)
+        return {"_error": True, "status_code": None, "url": url, "body": "deadline exceeded"}
     except Exception as e:
+        br.failure()
+        observe_upstream(url, t0, False)
         return {"_error": True, "status_code": None, "url": url, "body": str(e)}
+    finally:
+        br.release()
 
 async def http_post_json(url: str, json_body: dict, headers: dict | None = None):
-    c = _http_client()
+    c = _http_client(url)
+    host = httpx.URL(url).host
+    br = _breaker(host)
+    if not br.allow():
+        return _circuit_open_error(url)
+    t0 = time.monotonic()
     try:
         r = await c.post(url, json=json_body, headers=headers)
         r.raise_for_status()
-        return r.json()
+        br.success()
+        _record_latency(host, time.monotonic() - t0)
+        observe_upstream(url, t0, True)
+        return json_loads(r.content)
     except httpx.HTTPStatusError as e:
+        br.failure() if _is_host_failure(e) else br.success()
+        observe_upstream(url, t0, False)
         status = e.response.status_code if e.response else None
         body = ""
         try:
             body = e.response.text[:1200] if e.response else ""
         except Exception:
             pass
-        return {"_error": True, "status_code": status, "url": url, "body": body}
+        retry_after = e.response.headers.get("Retry-After") if e.response else None
+        return {"_error": True, "status_code": status, "url": url, "body": body, "retry_after": retry_after}
     except Exception as e:
+        br.failure()
+        observe_upstream(url, t0, False)
         return {"_error": True, "status_code": None, "url": url, "body": str(e)}
+    finally:
+        br.release()
+
+# کش TTL جلوی http_get_json: هر endpoint TTL خودش رو داره.
+# درخواست‌های همزمان روی یک کلید یکی می‌شن (single-flight) و بعد از انقضا
+# مقدار قدیمی سرو می‌شه تا یک refresh پس‌زمینه تموم بشه (stale-while-revalidate).
+CACHE_TTL = {
+    CODEBAZAN_ARZ_URL: 60.0,
+    CODEBAZAN_TALA_URL: 60.0,
+    COINLORE: 30.0,
+    CAR_ALL_URL: 600.0,
+}
+CACHE_MAX_STALE = float(os.getenv("CACHE_MAX_STALE", "3600"))
+
+_cache: dict[tuple, tuple[float, object]] = {}
+_inflight: dict[tuple, asyncio.Task] = {}
+# هر بار snapshot تازه‌ای از SNAPSHOT_URLS اومد با (name, data) صدا زده می‌شن
+snapshot_listeners: list = []
+
+def _cache_key(url: str, params: dict | None) -> tuple:
+    return (url, tuple(sorted((params or {}).items())))
+
+async def _cache_fill(key: tuple, url: str, params: dict | None, headers: dict | None):
+    try:
+        data = await http_get_json(url, params=params, headers=headers)
+        if not (isinstance(data, dict) and data.get("_error")):
+            _cache[key] = (time.monotonic(), data)
+            name = SNAPSHOT_NAMES.get(url)
+            if name and not params:
+                for listener in snapshot_listeners:
+                    try:
+                        listener(name, data)
+                    except Exception:
+                        logger.exception("Snapshot listener failed")
+        return data
+    finally:
+        _inflight.pop(key, None)
+
+def _cache_task(key: tuple, url: str, params: dict | None, headers: dict | None) -> asyncio.Task:
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(_cache_fill(key, url, params, headers))
+        _inflight[key] = task
+    return task
+
+async def cached_get_json(url: str, params: dict | None = None, headers: dict | None = None, ttl: float | None = None):
+    ttl = CACHE_TTL.get(url, 0.0) if ttl is None else ttl
+    if ttl <= 0:
+        return await http_get_json(url, params=params, headers=headers)
+
+    key = _cache_key(url, params)
+    hit = _cache.get(key)
+    age = time.monotonic() - hit[0] if hit else None
+    if hit and age < ttl:
+        return hit[1]
+
+    task = _cache_task(key, url, params, headers)
+    if hit and age < ttl + CACHE_MAX_STALE:
+        return hit[1]
+    # shield: اگه یکی از منتظرها cancel بشه، درخواست مشترک نباید بمیره
+    return await asyncio.shield(task)
+
+async def cache_refresh(url: str, params: dict | None = None, headers: dict | None = None):
+    # بدون توجه به TTL دوباره می‌گیره؛ برای prefetch پس‌زمینه
+    return await asyncio.shield(_cache_task(_cache_key(url, params), url, params, headers))
+
+# سقف زمان انتظار هر فیچر (ثانیه)؛ fetch مشترک بعد از deadline ادامه پیدا می‌کنه و کش رو پر می‌کنه
+FEATURE_DEADLINES = {
+    "fx": 5.0,
+    "gold": 5.0,
+    "crypto": 6.0,
+    "cars": 8.0,
+    "events": 6.0,
+    "digikala": 10.0,
+}
+
+@traced
+async def load_snapshots(*names: str, deadline: float | None = None) -> list:
+    # همه‌ی وابستگی‌ها همزمان گرفته می‌شن؛ کش + single-flight باعث می‌شه
+    # داخل یک درخواست و بین فیچرها فقط یک fetch برای هر snapshot بره.
+    tasks = [asyncio.ensure_future(cached_get_json(SNAPSHOT_URLS[n])) for n in names]
+    done, pending = await asyncio.wait(tasks, timeout=deadline)
+    for t in pending:
+        t.cancel()
+    return [
+        t.result() if t in done
+        else {"_error": True, "status_code": None, "url": SNAPSHOT_URLS[n], "body": "deadline exceeded"}
+        for n, t in zip(names, tasks)
+    ]
+
+_fx_index: tuple[object, dict[str, int]] | None = None
+
+def fx_index(data) -> dict[str, int]:
+    # name → قیمت (int)، یک بار برای هر snapshot ارز ساخته می‌شه
+    global _fx_index
+    if _fx_index is None or _fx_index[0] is not data:
+        idx = {}
+        items = data.get("Result") if isinstance(data, dict) else None
+        for it in items or []:
+            name = (it.get("name") or "").strip()
+            price = to_int_from_price_str(it.get("price"))
+            if name and price is not None:
+                idx.setdefault(name, price)
+        _fx_index = (data, idx)
+    return _fx_index[1]
+
+# کش خروجی رندرشده: برای هر کلید (فیچر یا صفحه) پیام‌های نهایی (بعد از chunk_text) و markup
+# نگه داشته می‌شه، همراه خود آبجکت داده‌ای که ازش ساخته شده. refresh یعنی آبجکت جدید، پس
+# «نسخه» همون identity داده‌ست (مثل fx_index) و entry قدیمی خودبه‌خود باطل می‌شه.
+RENDER_CACHE_MAX = int(os.getenv("RENDER_CACHE_MAX", "512"))
+
+_render_cache: OrderedDict[tuple, tuple[object, object]] = OrderedDict()
+render_stats = {"hits": 0, "misses": 0}
+
+def render_cached(key: tuple, source, build):
+    hit = _render_cache.get(key)
+    if hit is not None and hit[0] is source:
+        _render_cache.move_to_end(key)
+        render_stats["hits"] += 1
+        return hit[1]
+    render_stats["misses"] += 1
+    out = build()
+    _render_cache[key] = (source, out)
+    _render_cache.move_to_end(key)
+    while len(_render_cache) > RENDER_CACHE_MAX:
+        _render_cache.popitem(last=False)
+    return out
+
+def atomic_write(path: str, data: bytes, fsync: bool = False):
+    # هر نوشتن tmp یکتای خودش رو داره: چند worker uvicorn که یک پوشه رو share می‌کنن
+    # نباید یک فایل .tmp رو همزمان truncate و replace کنن
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=os.path.basename(path) + ".")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+# تاریخچه‌ی قیمت: برای هر نماد یک ring buffer با array('d') و اندازه‌ی ثابت
+# (پیش‌فرض ۲۸۸ خونه × ۵ دقیقه = ۲۴ ساعت). snapshotهای داخل یک step آخرین خونه رو
+# بازنویسی می‌کنن. min/max و sparkline با min/max/slice روی array (حلقه‌ی C) حساب می‌شن.
+HISTORY_STEP = float(os.getenv("HISTORY_STEP", "300"))
+HISTORY_SLOTS = int(os.getenv("HISTORY_SLOTS", "288"))
+HISTORY_PATH = os.getenv("HISTORY_PATH", "price_history.bin")
+HISTORY_MAX_SERIES = 500
+SPARK_CHARS = "▁▂▃▄▅▆▇█"
+
+class PriceSeries:
+    __slots__ = ("ts", "vals", "head", "n")
+
+    def __init__(self, size: int = HISTORY_SLOTS):
+        self.ts = array("d", bytes(8 * size))
+        self.vals = array("d", bytes(8 * size))
+        self.head = 0
+        self.n = 0
+
+    def add(self, t: float, v: float):
+        size = len(self.vals)
+        last = (self.head - 1) % size
+        if self.n and t - self.ts[last] < HISTORY_STEP:
+            self.vals[last] = v
+            return
+        self.ts[self.head] = t
+        self.vals[self.head] = v
+        self.head = (self.head + 1) % size
+        self.n = min(self.n + 1, size)
+
+    def _ordered(self, a: array) -> array:
+        if self.n < len(a):
+            return a[:self.n]
+        return a[self.head:] + a[:self.head]
+
+    def window(self, since: float) -> array:
+        ts = self._ordered(self.ts)
+        i = bisect.bisect_left(ts, since)
+        return self._ordered(self.vals)[i:]
+
+    def last_two(self) -> tuple[float, float] | None:
+        if self.n < 2:
+            return None
+        size = len(self.vals)
+        return self.vals[(self.head - 2) % size], self.vals[(self.head - 1) % size]
+
+price_history: dict[str, PriceSeries] = {}
+
+def record_price(key: str, value: float | None, t: float):
+    if value is None:
+        return
+    s = price_history.get(key)
+    if s is None:
+        if len(price_history) >= HISTORY_MAX_SERIES:
+            return
+        s = price_history[key] = PriceSeries()
+    s.add(t, float(value))
+
+def record_snapshot_history(name: str, data):
+    t = time.time()
+    if name in ("fx", "gold"):
+        for it in (data.get("Result") if isinstance(data, dict) else None) or []:
+            item_name = (it.get("name") or "").strip()
+            if item_name:
+                record_price(f"{name}:{item_name}", to_int_from_price_str(it.get("price")), t)
+    elif name == "coins":
+        for c in ((data.get("data") if isinstance(data, dict) else None) or [])[:15]:
+            symbol = (c.get("symbol") or "").upper()
+            try:
+                record_price(f"coin:{symbol}", float(c.get("price_usd")), t)
+            except (TypeError, ValueError):
+                pass
+
+snapshot_listeners.append(record_snapshot_history)
+
+def sparkline(vals: array, width: int = 12) -> str:
+    if len(vals) < 2:
+        return ""
+    step = max(1, math.ceil(len(vals) / width))
+    pts = vals[step - 1::step] if len(vals) > width else vals
+    lo, hi = min(pts), max(pts)
+    if hi == lo:
+        return SPARK_CHARS[0] * len(pts)
+    scale = (len(SPARK_CHARS) - 1) / (hi - lo)
+    return "".join(SPARK_CHARS[int((v - lo) * scale)] for v in pts)
+
+def fmt_num(v: float) -> str:
+    return f"{v:,.0f}" if abs(v) >= 100 else f"{v:,.4g}"
+
+def trend_text(key: str) -> str:
+    s = price_history.get(key)
+    pair = s.last_two() if s else None
+    if not pair:
+        return ""
+    prev, cur = pair
+    if cur == prev or not prev:
+        change = "＝"
+    else:
+        change = f"{'▲' if cur > prev else '▼'}{abs(cur - prev) / prev * 100:.1f}%"
+    day = s.window(time.time() - 86400)
+    if not day:
+        # سری‌ای که ۲۴ ساعته نمونه‌ی جدید نگرفته (قیمتش دیگه parse نمی‌شه) فقط تغییر آخر رو داره
+        return f" {change}"
+    return f" {change} {sparkline(day)} (۲۴س: {fmt_num(min(day))}–{fmt_num(max(day))})"
+
+def build_price_history() -> bytes:
+    # فرمت: b"PH1" + تعداد، و برای هر سری: طول نام، نام utf-8، size، head، n، ts، vals
+    out = [b"PH1", struct.pack("<I", len(price_history))]
+    for key, s in price_history.items():
+        k = key.encode("utf-8")
+        out.append(struct.pack("<H", len(k)) + k)
+        out.append(struct.pack("<III", len(s.vals), s.head, s.n))
+        out.append(s.ts.tobytes())
+        out.append(s.vals.tobytes())
+    return b"".join(out)
+
+def write_price_history(buf: bytes, path: str = HISTORY_PATH):
+    atomic_write(path, buf)
+
+def dump_price_history(path: str = HISTORY_PATH):
+    write_price_history(build_price_history(), path)
+
+def load_price_history(path: str = HISTORY_PATH):
+    try:
+        with open(path, "rb") as f:
+            buf = f.read()
+    except FileNotFoundError:
+        return
+    try:
+        if buf[:3] != b"PH1":
+            raise ValueError("bad magic")
+        (count,), pos = struct.unpack_from("<I", buf, 3), 7
+        for _ in range(count):
+            (klen,) = struct.unpack_from("<H", buf, pos)
+            key = buf[pos + 2:pos + 2 + klen].decode("utf-8")
+            pos += 2 + klen
+            size, head, n = struct.unpack_from("<III", buf, pos)
+            pos += 12
+            s = PriceSeries(size)
+            s.ts = array("d", buf[pos:pos + 8 * size])
+            s.vals = array("d", buf[pos + 8 * size:pos + 16 * size])
+            s.head, s.n = head, n
+            pos += 16 * size
+            price_history[key] = s
+    except Exception:
+        logger.exception("Price history file is corrupt; starting empty")
+        price_history.clear()
+
+async def history_dump_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        # مثل checkpoint_job: بایت‌ها روی event loop (listenerها اینجا ringها رو جلو می‌برن)، نوشتن تو thread
+        await asyncio.to_thread(write_price_history, build_price_history())
+    except Exception:
+        logger.exception("Price history dump failed")
 
 def chunk_text(text: str, limit: int = 3500):
     parts, cur = [], ""
@@ -183,44 +940,6 @@ def to_int_from_price_str(s: str) -> int | None:
     s2 = re.sub(r"[^\d]", "", str(s))
     return int(s2) if s2.isdigit() else None
 
-def gregorian_to_jalali(gy, gm, gd):
-    g_d_m = [0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334]
-    if gy > 1600:
-        jy = 979
-        gy -= 1600
-    else:
-        jy = 0
-        gy -= 621
-
-    gy2 = gy + 1 if gm > 2 else gy
-    days = (
-        365 * gy
-        + (gy2 + 3) // 4
-        - (gy2 + 99) // 100
-        + (gy2 + 399) // 400
-        - 80
-        + gd
-        + g_d_m[gm - 1]
-    )
-
-    jy += 33 * (days // 12053)
-    days %= 12053
-    jy += 4 * (days // 1461)
-    days %= 1461
-
-    if days > 365:
-        jy += (days - 1) // 365
-        days = (days - 1) % 365
-
-    if days < 186:
-        jm = 1 + days // 31
-        jd = 1 + (days % 31)
-    else:
-        jm = 7 + (days - 186) // 30
-        jd = 1 + ((days - 186) % 30)
-
-    return jy, jm, jd
-
 def gemini_headers():
     if not GEMINI_API_KEY:
         return None
@@ -242,27 +961,14 @@ def gemini_extract_text(resp: dict) -> str | None:
         return out if out else None
     return None
 
-async def gemini_chat(history: list[dict], user_text: str) -> str:
-    if not GEMINI_API_KEY:
-        return "❌ GEMINI_API_KEY تنظیم نشده. تو Render → Environment بذارش."
-
-    history = (history or [])[-12:]
-
-    contents = history + [{"role": "user", "parts": [{"text": user_text}]}]
-
-    payload = {
-        "systemInstruction": {  # طبق API reference :contentReference[oaicite:3]{index=3}
-            "parts": [{"text": "تو یک دستیار فارسیِ مودب و کوتاه‌گو هستی. پاسخ‌ها را روشن، کاربردی و خلاصه بده."}]
-        },
-        "contents": contents,
-        "generationConfig": {
-            "temperature": 0.7,
-            "maxOutputTokens": 512,
-        },
-    }
-
-    data = await http_post_json(GEMINI_URL(GEMINI_MODEL), payload, headers=gemini_headers())
+def gemini_extract_delta(chunk: dict) -> str:
+    # تو استریم هر chunk یک تکه از متنه؛ strip نمی‌کنیم تا فاصله‌ها حفظ بشن
+    parts = deep_get(chunk, ["candidates", 0, "content", "parts"], [])
+    if not isinstance(parts, list):
+        return ""
+    return "".join(str((p or {}).get("text") or "") for p in parts)
 
+def gemini_error_text(data) -> str | None:
     if isinstance(data, dict) and data.get("_error"):
         sc = data.get("status_code")
         body = str(data.get("body", ""))[:500]
@@ -276,50 +982,305 @@ async def gemini_chat(history: list[dict], user_text: str) -> str:
     block_reason = deep_get(data, ["promptFeedback", "blockReason"], None)
     if block_reason and not deep_get(data, ["candidates"], None):
         return "⚠️ درخواست به خاطر قوانین ایمنی Gemini بلاک شد. یه جور دیگه بپرس."
+    return None
+
+def gemini_payload(history: list[dict], user_text: str, summary: str | None = None) -> dict:
+    contents = list(history or []) + [{"role": "user", "parts": [{"text": user_text}]}]
+
+    system = GEMINI_SYSTEM_PROMPT
+    if summary:
+        system += "\n\nخلاصه‌ی گفتگوی قبلی با کاربر:\n" + summary
+
+    return {
+        "systemInstruction": {  # طبق API reference :contentReference[oaicite:3]{index=3}
+            "parts": [{"text": system}]
+        },
+        "contents": contents,
+        "generationConfig": {
+            "temperature": 0.7,
+            "maxOutputTokens": 512,
+        },
+    }
+
+async def gemini_chat(history: list[dict], user_text: str, summary: str | None = None) -> str:
+    if not GEMINI_API_KEY:
+        return "❌ GEMINI_API_KEY تنظیم نشده. تو Render → Environment بذارش."
+
+    payload = gemini_payload(history, user_text, summary)
+    data = await gemini_post(payload)
+
+    err = gemini_error_text(data)
+    if err:
+        return err
 
     txt = gemini_extract_text(data)
     return txt or "❌ پاسخی از Gemini نگرفتم. دوباره بفرست."
 
-async def feature_fx() -> str:
-    data = await http_get_json(CODEBAZAN_ARZ_URL)
+async def gemini_stream(history: list[dict], user_text: str, summary: str | None = None):
+    # نسخه‌ی SSE از gemini_chat: تکه‌های متن رو به محض رسیدن yield می‌کنه
+    if not GEMINI_API_KEY:
+        yield "❌ GEMINI_API_KEY تنظیم نشده. تو Render → Environment بذارش."
+        return
+
+    payload = gemini_payload(history, user_text, summary)
+    got_text = False
+    last = usage = None
+    url = GEMINI_STREAM_URL(GEMINI_MODEL)
+    for attempt in range(GEMINI_MAX_RETRIES + 1):
+        err = None
+        t0 = None
+        try:
+            async with gemini_gate.slot(GEMINI_PRIO_CHAT):
+                t0 = time.monotonic()
+                async with _http_client(url).stream(
+                    "POST", url, json=payload, headers=gemini_headers()
+                ) as r:
+                    if r.status_code >= 400:
+                        body = (await r.aread()).decode("utf-8", "replace")[:1200]
+                        err = {
+                            "_error": True,
+                            "status_code": r.status_code,
+                            "body": body,
+                            "retry_after": r.headers.get("Retry-After"),
+                        }
+                    else:
+                        async for line in r.aiter_lines():
+                            if not line.startswith("data:"):
+                                continue
+                            try:
+                                last = json_loads(line[5:])
+                            except ValueError:
+                                continue
+                            if last.get("usageMetadata"):
+                                usage = last
+                            delta = gemini_extract_delta(last)
+                            if delta:
+                                got_text = True
+                                yield delta
+                observe_upstream(url, t0, err is None)
+        except Exception as e:
+            if t0 is not None:
+                observe_upstream(url, t0, False)
+            yield f"\n❌ خطا از Gemini: {e}" if got_text else f"❌ خطا از Gemini: {e}"
+            return
+        if err is None:
+            # usageMetadata تو هر chunk تجمعیه؛ آخری رو ثبت می‌کنیم
+            record_gemini_usage(usage)
+            break
+        if gemini_should_retry(err) and attempt < GEMINI_MAX_RETRIES:
+            await asyncio.sleep(gemini_retry_delay(err, attempt))
+            continue
+        yield gemini_error_text(err)
+        return
+
+    if not got_text:
+        yield gemini_error_text(last) or "❌ پاسخی از Gemini نگرفتم. دوباره بفرست."
+
+# سقف همزمانی Gemini با صف اولویت‌دار: پاسخ چت (0) جلوتر از خلاصه‌سازی (1).
+# 429/503 با رعایت Retry-After (یا retryDelay داخل body) دوباره امتحان می‌شه.
+GEMINI_CONCURRENCY = int(os.getenv("GEMINI_CONCURRENCY", "4"))
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "2"))
+GEMINI_MAX_RETRY_WAIT = 20.0
+GEMINI_PRIO_CHAT = 0
+GEMINI_PRIO_BACKGROUND = 1
+
+class PrioritySemaphore:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        self._waiters: list = []
+        self._seq = itertools.count()
+
+    async def acquire(self, priority: int = 0):
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), fut))
+        try:
+            await fut
+        except asyncio.CancelledError:
+            # اگه جا بهش رسیده بود و بعد cancel شد، جا رو پس بده
+            if fut.done() and not fut.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        while self._waiters:
+            _, _, fut = heapq.heappop(self._waiters)
+            if not fut.done():
+                fut.set_result(None)  # جا مستقیم به منتظر بعدی می‌رسه
+                return
+        self.active -= 1
+
+    @asynccontextmanager
+    async def slot(self, priority: int = 0):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+gemini_gate = PrioritySemaphore(GEMINI_CONCURRENCY)
+
+def gemini_should_retry(data) -> bool:
+    return isinstance(data, dict) and data.get("_error") and data.get("status_code") in (429, 503)
+
+def gemini_retry_delay(data: dict, attempt: int) -> float:
+    delay = None
+    try:
+        delay = float(data.get("retry_after"))
+    except (TypeError, ValueError):
+        m = re.search(r'"retryDelay"\s*:\s*"(\d+(?:\.\d+)?)s"', str(data.get("body") or ""))
+        if m:
+            delay = float(m.group(1))
+    if delay is None:
+        delay = (2 ** attempt) * random.uniform(0.8, 1.2)
+    return min(delay, GEMINI_MAX_RETRY_WAIT)
+
+async def gemini_post(payload: dict, priority: int = GEMINI_PRIO_CHAT):
+    for attempt in range(GEMINI_MAX_RETRIES + 1):
+        async with gemini_gate.slot(priority):
+            data = await http_post_json(GEMINI_URL(GEMINI_MODEL), payload, headers=gemini_headers())
+        if not gemini_should_retry(data) or attempt == GEMINI_MAX_RETRIES:
+            record_gemini_usage(data)
+            return data
+        await asyncio.sleep(gemini_retry_delay(data, attempt))
+
+def approx_tokens(text: str | None) -> int:
+    # تخمین سرانگشتی: حدود ۴ کاراکتر برای هر توکن
+    return len(text or "") // 4 + 1
+
+def turn_tokens(turn: dict) -> int:
+    return sum(approx_tokens((p or {}).get("text")) for p in turn.get("parts") or [])
+
+_summary_tasks: dict[object, asyncio.Task] = {}
+
+def history_add(user_data: dict, key, user_text: str, reply: str, user_id: int | None = None):
+    # تاریخچه رو تا سقف GEMINI_HISTORY_TOKENS نگه می‌داره؛ اضافه‌ها می‌رن تو صف
+    # خلاصه‌سازی که خارج از مسیر پاسخ (تسک پس‌زمینه) اجرا می‌شه.
+    history = list(user_data.get("gemini_history") or [])
+    history.append({"role": "user", "parts": [{"text": user_text}]})
+    history.append({"role": "model", "parts": [{"text": reply}]})
+
+    total = sum(turn_tokens(t) for t in history)
+    dropped = []
+    while len(history) > 2 and total > GEMINI_HISTORY_TOKENS:
+        t = history.pop(0)
+        total -= turn_tokens(t)
+        dropped.append(t)
+    # تاریخچه باید با نوبت کاربر شروع بشه
+    while history and history[0].get("role") != "user":
+        dropped.append(history.pop(0))
+    user_data["gemini_history"] = history
+
+    if dropped:
+        user_data["gemini_overflow"] = list(user_data.get("gemini_overflow") or []) + dropped
+        if key not in _summary_tasks:
+            _summary_tasks[key] = asyncio.create_task(_summarize_history(user_data, key, user_id))
+
+async def gemini_summarize(summary: str | None, turns: list[dict]) -> str | None:
+    lines = []
+    if summary:
+        lines.append(f"خلاصه‌ی قبلی:\n{summary}\n")
+    for t in turns:
+        who = "کاربر" if t.get("role") == "user" else "دستیار"
+        text = " ".join((p or {}).get("text") or "" for p in t.get("parts") or [])
+        lines.append(f"{who}: {text}")
+    payload = {
+        "systemInstruction": {
+            "parts": [{"text": "گفتگوی زیر را در حداکثر ۱۲۰ کلمه به فارسی خلاصه کن. فقط نکات و اطلاعات مهم برای ادامه‌ی گفتگو را نگه دار."}]
+        },
+        "contents": [{"role": "user", "parts": [{"text": "\n".join(lines)}]}],
+        "generationConfig": {"temperature": 0.2, "maxOutputTokens": 256},
+    }
+    data = await gemini_post(payload, GEMINI_PRIO_BACKGROUND)
+    if gemini_error_text(data):
+        return None
+    return gemini_extract_text(data)
+
+async def _summarize_history(user_data: dict, key, user_id: int | None):
+    try:
+        while user_data.get("gemini_overflow"):
+            turns = user_data.pop("gemini_overflow")
+            summary = await gemini_summarize(user_data.get("gemini_summary"), turns)
+            # اگه وسط کار چت بسته شده باشه، خلاصه دیگه لازم نیست
+            if summary and user_data.get("chat_mode") is True:
+                user_data["gemini_summary"] = summary
+                # آپدیتی که این تسک رو ساخته تموم شده؛ بدون این، خلاصه تو persistence نمی‌ره
+                if user_id is not None:
+                    application.mark_data_for_update_persistence(user_ids=user_id)
+    except Exception:
+        logger.exception("History summary failed")
+    finally:
+        _summary_tasks.pop(key, None)
+
+async def stream_reply(message, stream, reply_markup=None, limit: int = 3500) -> str:
+    # یک پیام موقت می‌فرسته و با رسیدن تکه‌ها ادیتش می‌کنه؛ از limit که رد شد
+    # می‌ره سراغ پیام بعدی. متن کامل رو برمی‌گردونه (برای تاریخچه).
+    sent = await message.reply_text("…", reply_markup=reply_markup)
+    full, cur, shown = "", "", "…"
+    last_edit = 0.0
+
+    async def flush(text: str):
+        nonlocal shown, last_edit
+        if text and text != shown:
+            try:
+                await sent.edit_text(text)
+                shown = text
+            except TelegramError as e:
+                logger.warning("Stream edit failed: %s", e)
+        last_edit = time.monotonic()
+
+    async for delta in stream:
+        full += delta
+        cur += delta
+        parts = chunk_text(cur, limit)
+        if len(parts) > 1:
+            await flush(parts[0])
+            for part in parts[1:-1]:
+                await message.reply_text(part, reply_markup=reply_markup)
+            cur = parts[-1]
+            sent = await message.reply_text(cur, reply_markup=reply_markup)
+            shown, last_edit = cur, time.monotonic()
+        elif time.monotonic() - last_edit >= GEMINI_EDIT_INTERVAL:
+            await flush(cur)
+
+    await flush(cur)
+    return full.strip()
+
+@traced
+async def feature_fx() -> list[str] | str:
+    (data,) = await load_snapshots("fx", deadline=FEATURE_DEADLINES["fx"])
     items = data.get("Result") if isinstance(data, dict) else None
     if not items or (isinstance(data, dict) and data.get("_error")):
         return "💵 الان نتونستم قیمت ارز رو بگیرم."
-    lines = ["💵 قیمت ارز (منتخب)\n"]
-    for it in items[:30]:
+    return render_cached(("fx",), data, lambda: chunk_text(render_price_list("💵 قیمت ارز (منتخب)", "fx", items[:30])))
+
+def render_price_list(header: str, prefix: str, items: list) -> str:
+    lines = [header + "\n"]
+    for it in items:
         name = (it.get("name") or "").strip()
         price = (it.get("price") or "").strip()
         if name and price:
-            lines.append(f"• {name}: {price}")
+            lines.append(f"• {name}: {price}{trend_text(f'{prefix}:{name}')}")
     return "\n".join(lines).strip()
 
-async def feature_gold() -> str:
-    data = await http_get_json(CODEBAZAN_TALA_URL)
+@traced
+async def feature_gold() -> list[str] | str:
+    (data,) = await load_snapshots("gold", deadline=FEATURE_DEADLINES["gold"])
     items = data.get("Result") if isinstance(data, dict) else None
     if not items or (isinstance(data, dict) and data.get("_error")):
         return "🥇 الان نتونستم طلا و سکه رو بگیرم."
-    lines = ["🥇 طلا و سکه (منتخب)\n"]
-    for it in items[:35]:
-        name = (it.get("name") or "").strip()
-        price = (it.get("price") or "").strip()
-        if name and price:
-            lines.append(f"• {name}: {price}")
-    return "\n".join(lines).strip()
-
-async def get_usd_toman_rate() -> int | None:
-    data = await http_get_json(CODEBAZAN_ARZ_URL)
-    items = data.get("Result") if isinstance(data, dict) else []
-    for it in items or []:
-        if (it.get("name") or "").strip() == "دلار":
-            return to_int_from_price_str(it.get("price"))
-    return None
+    return render_cached(("gold",), data, lambda: chunk_text(render_price_list("🥇 طلا و سکه (منتخب)", "gold", items[:35])))
 
+@traced
 async def feature_crypto() -> str:
-    data = await http_get_json(COINLORE)
+    data, fx = await load_snapshots("coins", "fx", deadline=FEATURE_DEADLINES["crypto"])
     coins = data.get("data") if isinstance(data, dict) else None
     if not coins or (isinstance(data, dict) and data.get("_error")):
         return "₿ الان نتونستم قیمت ارز دیجیتال رو بگیرم."
-    usd_toman = await get_usd_toman_rate()
+    usd_toman = fx_index(fx).get("دلار")
     lines = ["₿ ارز دیجیتال (۱۵ کوین اول)\n"]
     for c in coins[:15]:
         name = c.get("name") or c.get("symbol") or "?"
@@ -332,14 +1293,19 @@ async def feature_crypto() -> str:
                 line += f" ≈ {p_tm:,} تومان"
             except Exception:
                 pass
+        line += trend_text(f"coin:{symbol}")
         lines.append(line)
     return "\n".join(lines).strip()
 
-async def feature_cars_all() -> str:
-    data = await http_get_json(CAR_ALL_URL)
+@traced
+async def feature_cars_all() -> list[str] | str:
+    (data,) = await load_snapshots("cars", deadline=FEATURE_DEADLINES["cars"])
     cars = data.get("cars") if isinstance(data, dict) else None
     if not cars or (isinstance(data, dict) and data.get("_error")):
         return "🚗 الان نتونستم لیست قیمت خودرو رو بگیرم."
+    return render_cached(("cars",), data, lambda: chunk_text(render_cars(cars)))
+
+def render_cars(cars: list) -> str:
     lines = ["🚗 قیمت خودرو (بخشی از لیست)\n"]
     for i, c in enumerate(cars[:80], start=1):
         brand = (c.get("brand") or "").strip()
@@ -350,11 +1316,227 @@ async def feature_cars_all() -> str:
         lines.append("\n(لیست خیلی طولانی بود؛ بخشی نمایش داده شد.)")
     return "\n".join(lines).strip()
 
+# ایندکس کامل خودروها: با هر refresh از snapshot «cars» دوباره ساخته می‌شه.
+# متن نرمال می‌شه (ی/ي، ک/ك، نیم‌فاصله، ارقام فارسی/عربی) و جستجو با پیشوند
+# توکن‌ها (bisect روی لیست مرتب) و برای کلمه‌های ۳+ حرفی با trigram انجام می‌شه.
+_FA_NORMALIZE = str.maketrans({
+    "ي": "ی", "ى": "ی", "ئ": "ی", "ك": "ک", "ؤ": "و", "ة": "ه", "ۀ": "ه", "أ": "ا", "إ": "ا", "آ": "ا",
+    "\u200c": " ", "\u200f": None, "\u200e": None, "ـ": None,
+    **{chr(0x06F0 + i): str(i) for i in range(10)},
+    **{chr(0x0660 + i): str(i) for i in range(10)},
+})
+_FA_DIACRITICS = re.compile(r"[\u064B-\u065F\u0670]")
+
+def normalize_fa(text: str) -> str:
+    text = _FA_DIACRITICS.sub("", (text or "").translate(_FA_NORMALIZE).lower())
+    return " ".join(text.split())
+
+def trigrams(token: str) -> set[str]:
+    return {token[i:i + 3] for i in range(len(token) - 2)}
+
+class CarIndex:
+    def __init__(self, cars: list):
+        self.rows: list[tuple[str, str, str]] = []
+        self.norm: list[str] = []
+        self.tokens: list[tuple[str, int]] = []
+        self.grams: dict[str, set[int]] = {}
+        for c in cars:
+            if not isinstance(c, dict):
+                continue
+            brand = (c.get("brand") or "").strip()
+            name = (c.get("name") or "").strip()
+            if not (brand or name):
+                continue
+            i = len(self.rows)
+            self.rows.append((brand, name, (c.get("market_price") or "").strip()))
+            n = normalize_fa(f"{brand} {name}")
+            self.norm.append(n)
+            for tok in set(n.split()):
+                self.tokens.append((tok, i))
+                for g in trigrams(tok):
+                    self.grams.setdefault(g, set()).add(i)
+        self.tokens.sort()
+
+    def _prefix(self, tok: str) -> set[int]:
+        out = set()
+        j = bisect.bisect_left(self.tokens, (tok, -1))
+        while j < len(self.tokens) and self.tokens[j][0].startswith(tok):
+            out.add(self.tokens[j][1])
+            j += 1
+        return out
+
+    def _candidates(self, tok: str) -> set[int]:
+        # prefix برای کلمه‌ی کوتاه (و نیمه‌تایپ‌شده)؛ trigram برای پیدا کردن وسط کلمه
+        ids = self._prefix(tok)
+        if len(tok) >= 3:
+            gs = sorted((self.grams.get(g, set()) for g in trigrams(tok)), key=len)
+            hit = set.intersection(*gs) if gs and gs[0] else set()
+            ids |= {i for i in hit if tok in self.norm[i]}
+        return ids
+
+    def search(self, query: str, limit: int = 25) -> list[tuple[str, str, str]]:
+        q = normalize_fa(query)
+        toks = q.split()
+        if not toks:
+            return []
+        ids = None
+        for tok in sorted(toks, key=len, reverse=True):
+            c = self._candidates(tok)
+            ids = c if ids is None else ids & c
+            if not ids:
+                return []
+        ranked = sorted(ids, key=lambda i: (not self.norm[i].startswith(q), q not in self.norm[i], len(self.norm[i])))
+        return [self.rows[i] for i in ranked[:limit]]
+
+car_index: CarIndex | None = None
+
+def rebuild_car_index(name: str, data):
+    global car_index
+    if name == "cars":
+        cars = data.get("cars") if isinstance(data, dict) else None
+        if cars:
+            car_index = CarIndex(cars)
+
+snapshot_listeners.append(rebuild_car_index)
+
+async def search_cars(query: str, limit: int = 25) -> list[tuple[str, str, str]] | None:
+    if car_index is None:
+        # فقط بار اول که ایندکس هنوز ساخته نشده
+        await load_snapshots("cars", deadline=FEATURE_DEADLINES["cars"])
+    if car_index is None:
+        return None
+    return car_index.search(query, limit)
+
+@traced
+async def feature_car_search(query: str) -> str:
+    rows = await search_cars(query)
+    if rows is None:
+        return "🚗 الان نتونستم لیست قیمت خودرو رو بگیرم."
+    if not rows:
+        return f"🚗 خودرویی برای «{query}» پیدا نشد."
+    lines = [f"🚗 نتایج جستجو برای «{query}»\n"]
+    for i, (brand, name, market) in enumerate(rows, start=1):
+        lines.append(f"{i}. {brand} {name} — بازار: {market}")
+    return "\n".join(lines).strip()
+
+async def inline_cars(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.inline_query
+    query = (q.query or "").strip()
+    if not query:
+        await q.answer([], cache_time=5)
+        return
+    rows = await search_cars(query, limit=20) or []
+    results = [
+        InlineQueryResultArticle(
+            id=str(i),
+            title=f"{brand} {name}".strip(),
+            description=f"بازار: {market}",
+            input_message_content=InputTextMessageContent(f"🚗 {brand} {name}\nقیمت بازار: {market}"),
+        )
+        for i, (brand, name, market) in enumerate(rows)
+    ]
+    await q.answer(results, cache_time=60)
+
+# تقویم مناسبت‌ها: روزهای آینده یک‌جا از holidayapi گرفته و روی دیسک ذخیره می‌شن.
+# کلید، تاریخ جلالیِ امروز به وقت تهرانه (نه UTC) و هر شب ساعت ۰۰:۰۰ تهران پنجره جلو می‌ره.
+try:
+    from zoneinfo import ZoneInfo
+    TEHRAN_TZ = ZoneInfo("Asia/Tehran")
+except Exception:
+    TEHRAN_TZ = timezone(timedelta(hours=3, minutes=30))
+
+HOLIDAY_CACHE_PATH = os.getenv("HOLIDAY_CACHE_PATH", "holidays.json")
+HOLIDAY_PREFETCH_DAYS = int(os.getenv("HOLIDAY_PREFETCH_DAYS", "31"))
+HOLIDAY_KEEP_DAYS = 7
+HOLIDAY_CONCURRENCY = 4
+
+holiday_calendar: dict[str, dict] = {}
+_holiday_fill: asyncio.Task | None = None
+_holiday_inflight: dict[str, asyncio.Task] = {}
+
+def tehran_today() -> jdatetime.date:
+    return jdatetime.date.fromgregorian(date=datetime.now(TEHRAN_TZ).date())
+
+def jalali_key(d: jdatetime.date) -> str:
+    return f"{d.year}/{d.month:02d}/{d.day:02d}"
+
+def load_holiday_calendar(path: str = HOLIDAY_CACHE_PATH):
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        if isinstance(data, dict):
+            holiday_calendar.update(data)
+    except FileNotFoundError:
+        pass
+    except Exception:
+        logger.exception("Holiday cache file is corrupt; starting empty")
+
+def save_holiday_calendar(text: str, path: str = HOLIDAY_CACHE_PATH):
+    atomic_write(path, text.encode("utf-8"))
+
+async def _fetch_holiday(d: jdatetime.date, deadline: float | None):
+    data = await http_get_json(HOLIDAY_URL.format(y=d.year, m=d.month, d=d.day), deadline=deadline)
+    if isinstance(data, dict) and not data.get("_error"):
+        holiday_calendar[jalali_key(d)] = data
+    return data
+
+async def fetch_holiday(d: jdatetime.date, deadline: float | None = None):
+    # single-flight برای هر روز: کاربری که امروز رو می‌خواد و fill پس‌زمینه یک درخواست مشترک دارن
+    key = jalali_key(d)
+    task = _holiday_inflight.get(key)
+    if task is None:
+        task = _holiday_inflight[key] = asyncio.create_task(_fetch_holiday(d, deadline))
+        task.add_done_callback(lambda _: _holiday_inflight.pop(key, None))
+    return await asyncio.shield(task)
+
+async def fill_holiday_calendar():
+    # از boot و feature_today_events بدون await صدا زده می‌شه؛ خطا باید همین‌جا لاگ بشه
+    try:
+        await _fill_holiday_calendar()
+    except Exception:
+        logger.exception("Holiday calendar fill failed")
+
+async def _fill_holiday_calendar():
+    today = tehran_today()
+    # روزهای خیلی قدیمی حذف می‌شن تا فایل کوچیک بمونه
+    oldest = jalali_key(today - timedelta(days=HOLIDAY_KEEP_DAYS))
+    for k in [k for k in holiday_calendar if k < oldest]:
+        del holiday_calendar[k]
+
+    days = [today + timedelta(days=i) for i in range(HOLIDAY_PREFETCH_DAYS)]
+    missing = [d for d in days if jalali_key(d) not in holiday_calendar]
+    if not missing:
+        return
+    sem = asyncio.Semaphore(HOLIDAY_CONCURRENCY)
+
+    async def one(d):
+        async with sem:
+            await fetch_holiday(d)
+
+    await asyncio.gather(*(one(d) for d in missing))
+    got = sum(1 for d in missing if jalali_key(d) in holiday_calendar)
+    logger.info("Holiday calendar: loaded %d/%d days", got, len(missing))
+    # serialize روی event loop؛ _fetch_holiday ممکنه همزمان روزی اضافه کنه
+    await asyncio.to_thread(save_holiday_calendar, json.dumps(holiday_calendar, ensure_ascii=False))
+
+def schedule_holiday_fill():
+    global _holiday_fill
+    if _holiday_fill is None or _holiday_fill.done():
+        _holiday_fill = asyncio.create_task(fill_holiday_calendar())
+    return _holiday_fill
+
+async def holiday_rollover_job(context: ContextTypes.DEFAULT_TYPE):
+    await schedule_holiday_fill()
+
+@traced
 async def feature_today_events() -> str:
-    now = datetime.now(timezone.utc)
-    jy, jm, jd = gregorian_to_jalali(now.year, now.month, now.day)
-    url = HOLIDAY_URL.format(y=jy, m=jm, d=jd)
-    data = await http_get_json(url)
+    today = tehran_today()
+    jy, jm, jd = today.year, today.month, today.day
+    data = holiday_calendar.get(jalali_key(today))
+    if data is None:
+        # fill امروز رو از همون درخواست fetch_holiday می‌گیره، دوباره نمی‌زنه
+        schedule_holiday_fill()
+        data = await fetch_holiday(today, deadline=FEATURE_DEADLINES["events"])
     if isinstance(data, dict) and data.get("_error"):
         return "📅 الان نتونستم مناسبت امروز رو بگیرم."
 
@@ -384,6 +1566,230 @@ async def feature_today_events() -> str:
         lines.append("\n(مناسبتی ثبت نشده)")
     return "\n".join(lines).strip()
 
+# هشدار قیمت: برای هر (نماد، جهت) یک لیست مرتب از آستانه‌ها نگه داشته می‌شه، پس با هر
+# snapshot تازه آستانه‌های ردشده با یک bisect پیدا می‌شن (نه اسکن همه‌ی اشتراک‌ها).
+# اشتراک‌ها تو SQLite ذخیره می‌شن؛ موقع شلیک، DELETE اتمیک تضمین می‌کنه که بین چند
+# پروسه فقط یک نفر پیام رو بفرسته. ارسال‌ها از TelegramRateLimiter رد می‌شن.
+ALERTS_DB_PATH = os.getenv("ALERTS_DB_PATH", os.getenv("STATE_DB_PATH", "bot_state.sqlite3"))
+ALERTS_PER_CHAT = 20
+ALERT_SEND_CONCURRENCY = 20
+_ALERT_RE = re.compile(r"^(.+?)\s*(>|<|بالای|بالاتر از|زیر|کمتر از)\s*([\d.,]+)$")
+
+class AlertEngine:
+    def __init__(self, path: str):
+        self.path = path
+        self._db: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+        self._eval_lock = asyncio.Lock()
+        # (instrument, op) → (thresholds مرتب، ids هم‌ترتیب)
+        self.books: dict[tuple[str, str], tuple[list[float], list[int]]] = {}
+        self.subs: dict[int, tuple[int, str, str, float, str]] = {}
+        self.by_chat: dict[int, set[int]] = {}
+        self.last_id = 0
+        self.stats = {"fired": 0, "sent": 0, "send_errors": 0}
+
+    def _conn(self) -> sqlite3.Connection:
+        if self._db is None:
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS alerts ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER NOT NULL, instrument TEXT NOT NULL, "
+                "op TEXT NOT NULL, threshold REAL NOT NULL, label TEXT NOT NULL)"
+            )
+            self._db = db
+        return self._db
+
+    def _db_call(self, sql: str, args: tuple = ()):
+        with self._lock:
+            cur = self._conn().execute(sql, args)
+            return cur.fetchall(), cur.rowcount, cur.lastrowid
+
+    def _claim(self, ids: list[int]) -> list[int]:
+        with self._lock:
+            db = self._conn()
+            # همه‌ی DELETEها تو یک تراکنش: یک commit برای کل snapshot، نه یکی برای هر هشدار
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                won = [i for i in ids if db.execute("DELETE FROM alerts WHERE id = ?", (i,)).rowcount == 1]
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+            return won
+
+    def _index(self, sub_id: int, chat_id: int, inst: str, op: str, thr: float, label: str):
+        if sub_id in self.subs:
+            return
+        self.subs[sub_id] = (chat_id, inst, op, thr, label)
+        self.by_chat.setdefault(chat_id, set()).add(sub_id)
+        thrs, ids = self.books.setdefault((inst, op), ([], []))
+        i = bisect.bisect_right(thrs, thr)
+        thrs.insert(i, thr)
+        ids.insert(i, sub_id)
+        self.last_id = max(self.last_id, sub_id)
+
+    def _unindex(self, sub_id: int):
+        sub = self.subs.pop(sub_id, None)
+        if sub is None:
+            return
+        chat_id, inst, op, thr, _ = sub
+        self.by_chat.get(chat_id, set()).discard(sub_id)
+        thrs, ids = self.books[(inst, op)]
+        i = bisect.bisect_left(thrs, thr)
+        while ids[i] != sub_id:
+            i += 1
+        del thrs[i], ids[i]
+
+    async def sync(self):
+        # اشتراک‌هایی که پروسه‌های دیگه اضافه کردن
+        rows, _, _ = await asyncio.to_thread(
+            self._db_call, "SELECT id, chat_id, instrument, op, threshold, label FROM alerts WHERE id > ?", (self.last_id,)
+        )
+        for row in rows:
+            self._index(*row)
+
+    async def add(self, chat_id: int, inst: str, op: str, thr: float, label: str) -> int:
+        _, _, sub_id = await asyncio.to_thread(
+            self._db_call,
+            "INSERT INTO alerts (chat_id, instrument, op, threshold, label) VALUES (?, ?, ?, ?, ?)",
+            (chat_id, inst, op, thr, label),
+        )
+        self._index(sub_id, chat_id, inst, op, thr, label)
+        return sub_id
+
+    async def remove(self, chat_id: int, sub_id: int) -> bool:
+        _, n, _ = await asyncio.to_thread(self._db_call, "DELETE FROM alerts WHERE id = ? AND chat_id = ?", (sub_id, chat_id))
+        if n:
+            self._unindex(sub_id)
+        return bool(n)
+
+    def for_chat(self, chat_id: int) -> list[tuple[int, str, str, float]]:
+        return sorted((i, self.subs[i][4], self.subs[i][2], self.subs[i][3]) for i in self.by_chat.get(chat_id, ()))
+
+    def crossed(self, inst: str, price: float) -> list[int]:
+        out = []
+        book = self.books.get((inst, ">"))
+        if book:
+            out += book[1][:bisect.bisect_left(book[0], price)]
+        book = self.books.get((inst, "<"))
+        if book:
+            out += book[1][bisect.bisect_right(book[0], price):]
+        return out
+
+    async def evaluate(self, prices: dict[str, float]):
+        async with self._eval_lock:
+            await self.sync()
+            fired = [(sid, price) for inst, price in prices.items() for sid in self.crossed(inst, price)]
+            if not fired:
+                return
+            claimed = set(await asyncio.to_thread(self._claim, [sid for sid, _ in fired]))
+            to_send = []
+            for sid, price in fired:
+                sub = self.subs.get(sid)
+                self._unindex(sid)
+                if sid in claimed and sub:
+                    to_send.append((sub, price))
+            self.stats["fired"] += len(to_send)
+        sem = asyncio.Semaphore(ALERT_SEND_CONCURRENCY)
+        await asyncio.gather(*(self._notify(sem, sub, price) for sub, price in to_send))
+
+    async def _notify(self, sem: asyncio.Semaphore, sub: tuple, price: float):
+        chat_id, _, op, thr, label = sub
+        async with sem:
+            try:
+                await application.bot.send_message(
+                    chat_id, f"🔔 هشدار قیمت: {label} الان {fmt_num(price)} است (شرط: {op} {fmt_num(thr)})"
+                )
+                self.stats["sent"] += 1
+            except TelegramError as e:
+                self.stats["send_errors"] += 1
+                logger.warning("Alert send to %s failed: %s", chat_id, e)
+
+alert_engine = AlertEngine(ALERTS_DB_PATH)
+_alert_tasks: set[asyncio.Task] = set()
+
+def snapshot_prices(name: str, data) -> dict[str, float]:
+    prices = {}
+    if name in ("fx", "gold"):
+        for it in (data.get("Result") if isinstance(data, dict) else None) or []:
+            item_name = (it.get("name") or "").strip()
+            v = to_int_from_price_str(it.get("price"))
+            if item_name and v is not None:
+                prices.setdefault(f"{name}:{item_name}", float(v))
+    elif name == "coins":
+        for c in (data.get("data") if isinstance(data, dict) else None) or []:
+            try:
+                prices[f"coin:{(c.get('symbol') or '').upper()}"] = float(c.get("price_usd"))
+            except (TypeError, ValueError):
+                pass
+    return prices
+
+def alert_snapshot_listener(name: str, data):
+    prices = snapshot_prices(name, data)
+    if prices:
+        t = asyncio.create_task(alert_engine.evaluate(prices))
+        _alert_tasks.add(t)
+        t.add_done_callback(_alert_tasks.discard)
+
+snapshot_listeners.append(alert_snapshot_listener)
+
+async def resolve_instrument(text: str) -> tuple[str, str] | None:
+    q = normalize_fa(text)
+    fx, gold, coins = await load_snapshots("fx", "gold", "coins", deadline=FEATURE_DEADLINES["crypto"])
+    for c in (coins.get("data") if isinstance(coins, dict) else None) or []:
+        sym = (c.get("symbol") or "").upper()
+        if sym and (q.upper() == sym or q == normalize_fa(c.get("name") or "")):
+            return f"coin:{sym}", sym
+    for name, data in (("fx", fx), ("gold", gold)):
+        for it in (data.get("Result") if isinstance(data, dict) else None) or []:
+            item_name = (it.get("name") or "").strip()
+            if item_name and normalize_fa(item_name) == q:
+                return f"{name}:{item_name}", item_name
+    return None
+
+async def alert_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    raw = normalize_fa(" ".join(context.args or [])).replace("٬", ",")
+    m = _ALERT_RE.match(raw)
+    if not m:
+        await update.message.reply_text("مثال: /alert دلار > 65000 یا /alert BTC < 50000", reply_markup=main_keyboard)
+        return
+    name, op_word, num = m.groups()
+    op = ">" if op_word in (">", "بالای", "بالاتر از") else "<"
+    try:
+        thr = float(num.replace(",", ""))
+    except ValueError:
+        await update.message.reply_text("❌ عدد آستانه نامعتبره.", reply_markup=main_keyboard)
+        return
+    if len(alert_engine.by_chat.get(chat_id, ())) >= ALERTS_PER_CHAT:
+        await update.message.reply_text(f"❌ حداکثر {ALERTS_PER_CHAT} هشدار فعال می‌تونی داشته باشی.", reply_markup=main_keyboard)
+        return
+    inst = await resolve_instrument(name)
+    if inst is None:
+        await update.message.reply_text(f"❌ «{name}» رو تو لیست ارز، طلا یا رمزارزها پیدا نکردم.", reply_markup=main_keyboard)
+        return
+    sub_id = await alert_engine.add(chat_id, inst[0], op, thr, inst[1])
+    await update.message.reply_text(f"✅ هشدار #{sub_id} ثبت شد: {inst[1]} {op} {fmt_num(thr)}", reply_markup=main_keyboard)
+
+async def alerts_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await alert_engine.sync()
+    rows = alert_engine.for_chat(update.effective_chat.id)
+    if not rows:
+        await update.message.reply_text("🔔 هشدار فعالی نداری.", reply_markup=main_keyboard)
+        return
+    lines = ["🔔 هشدارهای فعال:\n"] + [f"#{i}: {label} {op} {fmt_num(thr)}" for i, label, op, thr in rows]
+    await update.message.reply_text("\n".join(lines), reply_markup=main_keyboard)
+
+async def unalert_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        sub_id = int(normalize_fa((context.args or [""])[0]).lstrip("#"))
+    except ValueError:
+        await update.message.reply_text("مثال: /unalert 12", reply_markup=main_keyboard)
+        return
+    ok = await alert_engine.remove(update.effective_chat.id, sub_id)
+    await update.message.reply_text("✅ حذف شد." if ok else "❌ همچین هشداری پیدا نشد.", reply_markup=main_keyboard)
+
 def dk_extract_products(payload: dict) -> list[dict]:
     for path in (["data", "products"], ["data", "search", "products"], ["data", "items"], ["products"]):
         v = deep_get(payload, path, None)
@@ -391,6 +1797,61 @@ def dk_extract_products(payload: dict) -> list[dict]:
             return v
     return []
 
+DK_PAGE_ITEMS = 12
+_DK_LIST_KEY = re.compile(rb'"(?:products|items)"\s*:\s*\[')
+_DK_WINDOW = 64 * 1024
+_json_decoder = json.JSONDecoder()
+_WS = " \t\r\n"
+
+def _scan_array(text: str, i: int, limit: int) -> list | None:
+    # عنصرهای آرایه رو یکی‌یکی با raw_decode می‌خونه و بعد از limit تا متوقف می‌شه؛
+    # None یعنی متن (پنجره) قبل از رسیدن به limit یا «]» تموم شد.
+    items = []
+    n = len(text)
+    while len(items) < limit:
+        while i < n and text[i] in _WS:
+            i += 1
+        if i >= n:
+            return None
+        if text[i] == "]":
+            break
+        try:
+            obj, i = _json_decoder.raw_decode(text, i)
+        except ValueError:
+            return None
+        items.append(obj)
+        while i < n and text[i] in _WS:
+            i += 1
+        if i >= n:
+            return None
+        if text[i] == "]":
+            break
+        if text[i] != ",":
+            raise ValueError("malformed array")
+        i += 1
+    return items
+
+def dk_decode_products(body: bytes, limit: int = DK_PAGE_ITEMS) -> list:
+    # فقط limit محصول اول از آرایه‌ی products ساخته می‌شه؛ فیلترها، بقیه‌ی محصولات و
+    # هر چیزی بعد از اون اصلاً parse نمی‌شه. ساختار غیرمنتظره → parse کامل مثل قبل.
+    m = _DK_LIST_KEY.search(body)
+    if m:
+        start, size = m.end(), _DK_WINDOW
+        while True:
+            end = min(len(body), start + size)
+            try:
+                items = _scan_array(body[start:end].decode("utf-8", "ignore"), 0, limit)
+            except ValueError:
+                break
+            if items is not None:
+                if items and all(isinstance(p, dict) and ("title_fa" in p or "default_variant" in p) for p in items):
+                    return items
+                break
+            if end >= len(body):
+                break
+            size *= 4
+    return dk_extract_products(json_loads(body))[:limit]
+
 def dk_price_text(prod: dict) -> str:
     dv = prod.get("default_variant") if isinstance(prod, dict) else None
     if isinstance(dv, dict):
@@ -405,50 +1866,452 @@ def dk_price_text(prod: dict) -> str:
                 return s
     return "—"
 
+# کش LRU صفحات دیجی‌کالا با کلید (نوع، query/slug، صفحه). فقط عنوان و متن قیمتِ
+# ۱۲ محصول اول نگه داشته می‌شه، پس حجم هر entry کوچیک و سقف تعداد = سقف حافظه.
+DK_CACHE_MAX = int(os.getenv("DK_CACHE_MAX", "256"))
+DK_CACHE_TTL = float(os.getenv("DK_CACHE_TTL", "300"))
+
+_dk_cache: OrderedDict[tuple, tuple[float, list]] = OrderedDict()
+_dk_inflight: dict[tuple, asyncio.Task] = {}
+dk_cache_stats = {"hits": 0, "misses": 0, "evictions": 0, "prefetches": 0}
+
+def _num(v) -> float | None:
+    return v if isinstance(v, (int, float)) and not isinstance(v, bool) else None
+
+def dk_slim_products(prods: list) -> list[tuple]:
+    # (id، عنوان، متن قیمت، قیمت عددی، درصد تخفیف) — دوتای آخر برای مرتب‌سازی جستجوی سراسری
+    out = []
+    for p in prods[:DK_PAGE_ITEMS]:
+        if not isinstance(p, dict):
+            continue
+        title = p.get("title_fa") or p.get("title") or p.get("name") or "بدون عنوان"
+        price = deep_get(p, ["default_variant", "price"], None)
+        price = price if isinstance(price, dict) else {}
+        out.append((
+            p.get("id"), str(title).strip(), dk_price_text(p),
+            _num(price.get("selling_price")), _num(price.get("discount_percent")) or 0,
+        ))
+    return out
+
+def _dk_request(kind: str, ident, page: int):
+    if kind == "q":
+        return DK_SEARCH, {"q": ident, "page": page}
+    if kind == "cq":
+        slug, q = ident
+        return DK_CATEGORY.format(slug=slug), {"q": q, "page": page}
+    return DK_CATEGORY.format(slug=ident), {"page": page}
+
+async def _dk_fetch(key: tuple):
+    try:
+        url, params = _dk_request(*key)
+        prods = await http_get_json(url, params=params, decode=dk_decode_products)
+        if isinstance(prods, dict) and prods.get("_error"):
+            return None
+        items = dk_slim_products(prods)
+        _dk_store(key, time.monotonic(), items)
+        return items
+    finally:
+        _dk_inflight.pop(key, None)
+
+def _dk_store(key: tuple, ts: float, items: list):
+    _dk_cache[key] = (ts, items)
+    _dk_cache.move_to_end(key)
+    while len(_dk_cache) > DK_CACHE_MAX:
+        _dk_cache.popitem(last=False)
+        dk_cache_stats["evictions"] += 1
+
+def _dk_cached(key: tuple):
+    hit = _dk_cache.get(key)
+    if hit is None and key in _dk_lazy:
+        hit = _dk_hydrate(key)
+    if hit and time.monotonic() - hit[0] < DK_CACHE_TTL:
+        _dk_cache.move_to_end(key)
+        return hit[1]
+    return None
+
+@traced
+async def dk_get_page(kind: str, ident, page: int) -> list[tuple] | None:
+    key = (kind, ident, page)
+    items = _dk_cached(key)
+    if items is not None:
+        dk_cache_stats["hits"] += 1
+        return items
+    dk_cache_stats["misses"] += 1
+    task = _dk_inflight.get(key)
+    if task is None:
+        task = _dk_inflight[key] = asyncio.create_task(_dk_fetch(key))
+    try:
+        return await asyncio.wait_for(asyncio.shield(task), FEATURE_DEADLINES["digikala"])
+    except asyncio.TimeoutError:
+        return None
+
+def dk_prefetch(kind: str, ident: str, page: int):
+    # صفحه‌ی بعد رو حدسی از قبل می‌گیریم تا کلیک «بعدی» از حافظه جواب بگیره
+    key = (kind, ident, page)
+    if key in _dk_inflight or _dk_cached(key) is not None:
+        return
+    dk_cache_stats["prefetches"] += 1
+    _dk_inflight[key] = asyncio.create_task(_dk_fetch(key))
+
+@traced
 async def dk_search(query: str, page: int = 1):
-    payload = await http_get_json(DK_SEARCH, params={"q": query, "page": page})
-    if isinstance(payload, dict) and payload.get("_error"):
+    prods = await dk_get_page("q", query, page)
+    if prods is None:
         return "🛒 دیجی‌کالا الان پاسخ نداد.", None
 
-    prods = dk_extract_products(payload)
     if not prods:
         return f"🛒 نتیجه‌ای برای «{query}» پیدا نشد.", None
 
-    lines = [f"🛒 دیجی‌کالا | جستجو: «{query}» | صفحه {page}\n"]
-    for p in prods[:12]:
-        title = p.get("title_fa") or p.get("title") or p.get("name") or "بدون عنوان"
-        price = dk_price_text(p)
-        lines.append(f"• {str(title).strip()}\n  💰 {price}\n")
+    dk_prefetch("q", query, page + 1)
+    return render_cached(
+        ("dk", "q", query, page), prods,
+        lambda: render_dk_page(f"🛒 دیجی‌کالا | جستجو: «{query}» | صفحه {page}", prods, "dks_", page),
+    )
+
+def render_dk_page(header: str, prods: list, cb_prefix: str, page: int):
+    lines = [header + "\n"]
+    for _, title, price, _, _ in prods:
+        lines.append(f"• {title}\n  💰 {price}\n")
 
     nav = []
     if page > 1:
-        nav.append(InlineKeyboardButton("⬅️ قبلی", callback_data=f"dks_{page-1}"))
-    nav.append(InlineKeyboardButton("➡️ بعدی", callback_data=f"dks_{page+1}"))
-    markup = InlineKeyboardMarkup([nav])
-    return "\n".join(lines).strip(), markup
+        nav.append(InlineKeyboardButton("⬅️ قبلی", callback_data=f"{cb_prefix}{page-1}"))
+    nav.append(InlineKeyboardButton("➡️ بعدی", callback_data=f"{cb_prefix}{page+1}"))
+    return "\n".join(lines).strip(), InlineKeyboardMarkup([nav])
 
+@traced
 async def dk_category(slug: str, title_fa: str, page: int = 1):
-    url = DK_CATEGORY.format(slug=slug)
-    payload = await http_get_json(url, params={"page": page})
-    if isinstance(payload, dict) and payload.get("_error"):
+    prods = await dk_get_page("cat", slug, page)
+    if prods is None:
         return "🛒 دیجی‌کالا الان پاسخ نداد.", None
 
-    prods = dk_extract_products(payload)
     if not prods:
         return f"🛒 دیجی‌کالا | {title_fa}\nنتیجه‌ای پیدا نشد.", None
 
-    lines = [f"🛒 دیجی‌کالا | دسته: {title_fa} | صفحه {page}\n"]
-    for p in prods[:12]:
-        title = p.get("title_fa") or p.get("title") or p.get("name") or "بدون عنوان"
-        price = dk_price_text(p)
-        lines.append(f"• {str(title).strip()}\n  💰 {price}\n")
+    dk_prefetch("cat", slug, page + 1)
+    return render_cached(
+        ("dk", "cat", slug, title_fa, page), prods,
+        lambda: render_dk_page(f"🛒 دیجی‌کالا | دسته: {title_fa} | صفحه {page}", prods, f"dkc_{slug}_", page),
+    )
+
+# جستجو در همه‌ی دسته‌ها: همه‌ی (دسته، صفحه)ها با سقف همزمانی گرفته می‌شن (از همون کش و
+# single-flight صفحه‌ها)، هر صفحه جدا مرتب و بعد با heapq.merge یکی می‌شه و تکراری‌ها با
+# id حذف می‌شن. نتیجه‌ی ادغام‌شده تو حافظه می‌مونه و صفحه‌بندی فقط از روی همون لیسته.
+DK_ALL_PAGES = int(os.getenv("DK_ALL_PAGES", "3"))
+DK_ALL_CONCURRENCY = int(os.getenv("DK_ALL_CONCURRENCY", "6"))
+DK_ALL_PAGE_SIZE = 10
+DK_MERGED_MAX = 64
+DK_ALL_SORTS = {
+    "p": ("ارزان‌ترین", lambda it: (it[3] is None, it[3] or 0)),
+    "d": ("بیشترین تخفیف", lambda it: (-it[4], it[3] is None, it[3] or 0)),
+}
+
+_dk_merged: OrderedDict[str, tuple[float, dict[str, list]]] = OrderedDict()
+
+async def dk_collect_all(query: str) -> list[tuple[str, list]] | None:
+    sem = asyncio.Semaphore(DK_ALL_CONCURRENCY)
+
+    async def one(slug: str, page: int):
+        async with sem:
+            return await dk_get_page("cq", (slug, query), page)
+
+    sources = [(title, slug, page) for slug, title in DIGIKALA_CATS.values() for page in range(1, DK_ALL_PAGES + 1)]
+    results = await asyncio.gather(*(one(slug, page) for _, slug, page in sources))
+    got = [(title, items) for (title, _, _), items in zip(sources, results) if items is not None]
+    return got if got else None
+
+def dk_merge(sources: list[tuple[str, list]], key) -> list[tuple]:
+    runs = [sorted(((*it, title) for it in items), key=key) for title, items in sources]
+    seen = set()
+    out = []
+    for it in heapq.merge(*runs, key=key):
+        pid = it[0] if it[0] is not None else it[1]
+        if pid not in seen:
+            seen.add(pid)
+            out.append(it)
+    return out
+
+@traced
+async def dk_merged_results(query: str) -> dict[str, list] | None:
+    hit = _dk_merged.get(query)
+    if hit and time.monotonic() - hit[0] < DK_CACHE_TTL:
+        _dk_merged.move_to_end(query)
+        return hit[1]
+    sources = await dk_collect_all(query)
+    if sources is None:
+        return None
+    merged = {sort: dk_merge(sources, key) for sort, (_, key) in DK_ALL_SORTS.items()}
+    _dk_merged[query] = (time.monotonic(), merged)
+    while len(_dk_merged) > DK_MERGED_MAX:
+        _dk_merged.popitem(last=False)
+    return merged
+
+@traced
+async def dk_search_all(query: str, sort: str = "p", page: int = 1):
+    merged = await dk_merged_results(query)
+    if merged is None:
+        return "🛒 دیجی‌کالا الان پاسخ نداد.", None
+    items = merged.get(sort) or []
+    if not items:
+        return f"🛒 تو هیچ‌کدوم از دسته‌ها نتیجه‌ای برای «{query}» پیدا نشد.", None
+
+    pages = math.ceil(len(items) / DK_ALL_PAGE_SIZE)
+    page = min(max(page, 1), pages)
+    return render_cached(("dk", "all", query, sort, page), items, lambda: render_dk_all(query, items, sort, page, pages))
+
+def render_dk_all(query: str, items: list, sort: str, page: int, pages: int):
+    label = DK_ALL_SORTS[sort][0]
+    lines = [f"🛒 دیجی‌کالا | همه‌ی دسته‌ها: «{query}» | {label} | صفحه {page}/{pages} ({len(items)} کالا)\n"]
+    for _, title, price, _, _, cat in items[(page - 1) * DK_ALL_PAGE_SIZE:page * DK_ALL_PAGE_SIZE]:
+        lines.append(f"• {title}\n  💰 {price} · {cat}\n")
 
     nav = []
     if page > 1:
-        nav.append(InlineKeyboardButton("⬅️ قبلی", callback_data=f"dkc_{slug}_{page-1}"))
-    nav.append(InlineKeyboardButton("➡️ بعدی", callback_data=f"dkc_{slug}_{page+1}"))
-    markup = InlineKeyboardMarkup([nav])
-    return "\n".join(lines).strip(), markup
+        nav.append(InlineKeyboardButton("⬅️ قبلی", callback_data=f"dka_{sort}_{page-1}"))
+    if page < pages:
+        nav.append(InlineKeyboardButton("➡️ بعدی", callback_data=f"dka_{sort}_{page+1}"))
+    other = "d" if sort == "p" else "p"
+    rows = [nav] if nav else []
+    rows.append([InlineKeyboardButton(f"↕️ {DK_ALL_SORTS[other][0]}", callback_data=f"dka_{other}_1")])
+    return "\n".join(lines).strip(), InlineKeyboardMarkup(rows)
+
+# Checkpoint برای ری‌استارت گرم: snapshotها و کش صفحات دیجی‌کالا هر چند دقیقه و موقع
+# خاموش شدن تو یک فایل نوشته می‌شن (tmp + os.replace). فرمت: b"CK1"، زمان، تعداد، بعد
+# ایندکس (نوع، طول کلید، سن، offset، طول بلاب، کلید) و در آخر بلاب‌های JSON. موقع بالا
+# اومدن فقط ایندکس از روی mmap خونده می‌شه؛ snapshotها همون موقع و صفحات دیجی‌کالا
+# اولین باری که خواسته بشن decode می‌شن.
+CHECKPOINT_PATH = os.getenv("CHECKPOINT_PATH", "cache_checkpoint.bin")
+CHECKPOINT_INTERVAL = float(os.getenv("CHECKPOINT_INTERVAL", "120"))
+CK_CACHE, CK_DK = 0, 1
+_CK_HEAD = struct.Struct("<3sdI")
+_CK_ENTRY = struct.Struct("<BHdQI")
+
+_ck_map: mmap.mmap | None = None
+_dk_lazy: dict[tuple, tuple[float, int, int]] = {}
+checkpoint_stats = {"written": 0, "bytes": 0, "restored": 0, "lazy": 0, "hydrated": 0}
+
+def _tuplify(v):
+    return tuple(_tuplify(x) for x in v) if isinstance(v, list) else v
+
+def _dk_hydrate(key: tuple):
+    ts, off, ln = _dk_lazy.pop(key)
+    try:
+        items = [tuple(it) for it in json_loads(_ck_map[off:off + ln])]
+    except Exception:
+        logger.exception("Checkpoint entry %r is corrupt", key)
+        return None
+    checkpoint_stats["hydrated"] += 1
+    _dk_store(key, ts, items)
+    return ts, items
+
+def build_checkpoint() -> bytes:
+    now = time.monotonic()
+    entries = []
+    for key, (ts, data) in _cache.items():
+        entries.append((CK_CACHE, json_dumps(key), now - ts, json_dumps(data)))
+    for key, (ts, items) in _dk_cache.items():
+        if now - ts < DK_CACHE_TTL:
+            entries.append((CK_DK, json_dumps(key), now - ts, json_dumps(items)))
+    for key, (ts, off, ln) in list(_dk_lazy.items()):
+        # هنوز decode نشده: بایت‌ها مستقیم از فایل قبلی کپی می‌شن
+        if now - ts < DK_CACHE_TTL:
+            entries.append((CK_DK, json_dumps(key), now - ts, _ck_map[off:off + ln]))
+        else:
+            del _dk_lazy[key]
+    off = _CK_HEAD.size + sum(_CK_ENTRY.size + len(k) for _, k, _, _ in entries)
+    index, blobs = [_CK_HEAD.pack(b"CK1", time.time(), len(entries))], []
+    for kind, k, age, blob in entries:
+        index.append(_CK_ENTRY.pack(kind, len(k), age, off, len(blob)) + k)
+        blobs.append(blob)
+        off += len(blob)
+    return b"".join(index + blobs)
+
+def write_checkpoint(buf: bytes, path: str = CHECKPOINT_PATH):
+    atomic_write(path, buf, fsync=True)
+    checkpoint_stats["written"] += 1
+    checkpoint_stats["bytes"] = len(buf)
+
+def checkpoint_now():
+    global _ck_map
+    write_checkpoint(build_checkpoint())
+    if _ck_map is not None and not _dk_lazy:
+        _ck_map.close()
+        _ck_map = None
+
+async def checkpoint_job(context: ContextTypes.DEFAULT_TYPE):
+    global _ck_map
+    try:
+        # ساختن بایت‌ها روی event loop (داده‌ها اینجا عوض می‌شن)، نوشتن تو thread
+        await asyncio.to_thread(write_checkpoint, build_checkpoint())
+        if _ck_map is not None and not _dk_lazy:
+            _ck_map.close()
+            _ck_map = None
+    except Exception:
+        logger.exception("Checkpoint failed")
+
+def load_checkpoint(path: str = CHECKPOINT_PATH):
+    global _ck_map
+    try:
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):
+        return
+    try:
+        magic, wall, count = _CK_HEAD.unpack_from(mm, 0)
+        if magic != b"CK1":
+            raise ValueError("bad magic")
+        # سن هر entry = سنش موقع نوشتن + مدتی که پروسه خاموش بوده
+        now, down = time.monotonic(), max(0.0, time.time() - wall)
+        pos = _CK_HEAD.size
+        for _ in range(count):
+            kind, klen, age, off, ln = _CK_ENTRY.unpack_from(mm, pos)
+            pos += _CK_ENTRY.size
+            key = _tuplify(json_loads(mm[pos:pos + klen]))
+            pos += klen
+            ts = now - age - down
+            if kind == CK_CACHE and age + down < CACHE_TTL.get(key[0], 0.0) + CACHE_MAX_STALE:
+                data = json_loads(mm[off:off + ln])
+                _cache[key] = (ts, data)
+                checkpoint_stats["restored"] += 1
+                if key[0] == CAR_ALL_URL:
+                    rebuild_car_index("cars", data)
+            elif kind == CK_DK and age + down < DK_CACHE_TTL:
+                _dk_lazy[key] = (ts, off, ln)
+        checkpoint_stats["lazy"] = len(_dk_lazy)
+    except Exception:
+        logger.exception("Checkpoint file is corrupt; starting cold")
+        _dk_lazy.clear()
+    if _dk_lazy:
+        _ck_map = mm
+    else:
+        mm.close()
+    logger.info("Checkpoint: %d snapshots restored, %d pages lazy", checkpoint_stats["restored"], len(_dk_lazy))
+
+# Prefetch: هر upstream با فاصله‌ی خودش از طریق job_queue گرم نگه داشته می‌شه
+# تا دکمه‌ها فقط از کش بخونن. jitter برای پخش شدن درخواست‌ها، back-off برای خطا.
+PREFETCH_ENABLED = os.getenv("PREFETCH", "1") != "0"
+PREFETCH_INTERVALS = {
+    "fx": 45.0,
+    "gold": 45.0,
+    "coins": 20.0,
+    "cars": 300.0,
+}
+PREFETCH_JITTER = 0.15
+PREFETCH_MAX_BACKOFF = 900.0
+
+_prefetch_failures: dict[str, int] = {}
+
+async def prefetch_job(context: ContextTypes.DEFAULT_TYPE):
+    name = context.job.data
+    interval = PREFETCH_INTERVALS[name]
+    delay = interval
+    try:
+        data = await cache_refresh(SNAPSHOT_URLS[name])
+        if isinstance(data, dict) and data.get("_error"):
+            n = _prefetch_failures[name] = _prefetch_failures.get(name, 0) + 1
+            delay = min(interval * (2 ** n), PREFETCH_MAX_BACKOFF)
+            logger.warning("Prefetch %s failed (%s), retry in %.0fs", name, data.get("status_code"), delay)
+        else:
+            _prefetch_failures[name] = 0
+    except Exception:
+        logger.exception("Prefetch %s crashed", name)
+    finally:
+        delay *= random.uniform(1 - PREFETCH_JITTER, 1 + PREFETCH_JITTER)
+        context.job_queue.run_once(prefetch_job, delay, data=name, name=f"prefetch:{name}")
+
+def schedule_prefetch(app):
+    if app.job_queue is None:
+        logger.warning("job_queue در دسترس نیست؛ prefetch غیرفعال شد.")
+        return
+    for name in PREFETCH_INTERVALS:
+        app.job_queue.run_once(prefetch_job, random.uniform(0, 3.0), data=name, name=f"prefetch:{name}")
+
+# پیام‌های پشت‌سرهم چت: handler فقط پیام رو تو بافر اون چت می‌ذاره و برمی‌گرده؛ یک task
+# برای هر چت صبر می‌کنه تا GEMINI_DEBOUNCE ثانیه پیام تازه نیاد، بعد همه رو با هم یک
+# درخواست می‌کنه. پیام‌هایی که وسط یک درخواست برسن دور بعد با هم می‌رن، پس برای هر
+# چت همیشه حداکثر یک فراخوانی Gemini در جریانه و تاریخچه ترتیبش به‌هم نمی‌ریزه.
+GEMINI_DEBOUNCE = float(os.getenv("GEMINI_DEBOUNCE", "1.2"))
+GEMINI_COALESCE_MAX_CHARS = 4000
+
+class ChatCoalescer:
+    def __init__(self):
+        self.pending: dict[int, list] = {}
+        self.last_at: dict[int, float] = {}
+        self.tasks: dict[int, asyncio.Task] = {}
+        self.stats = {"messages": 0, "calls": 0, "coalesced": 0}
+
+    def submit(self, chat_id: int, message, text: str, user_data: dict, user_id: int | None):
+        self.stats["messages"] += 1
+        self.pending.setdefault(chat_id, []).append((message, text))
+        self.last_at[chat_id] = time.monotonic()
+        if chat_id not in self.tasks:
+            self.tasks[chat_id] = asyncio.create_task(self._run(chat_id, user_data, user_id))
+
+    def _take(self, chat_id: int) -> list:
+        # تا سقف طول؛ بقیه برای دور بعد می‌مونه
+        buf = self.pending.get(chat_id) or []
+        n, size = 0, 0
+        while n < len(buf) and (n == 0 or size + len(buf[n][1]) <= GEMINI_COALESCE_MAX_CHARS):
+            size += len(buf[n][1])
+            n += 1
+        batch, rest = buf[:n], buf[n:]
+        if rest:
+            self.pending[chat_id] = rest
+        else:
+            self.pending.pop(chat_id, None)
+        return batch
+
+    async def _run(self, chat_id: int, user_data: dict, user_id: int | None):
+        try:
+            while True:
+                while (wait := self.last_at[chat_id] + GEMINI_DEBOUNCE - time.monotonic()) > 0:
+                    await asyncio.sleep(wait)
+                batch = self._take(chat_id)
+                if not batch:
+                    return
+                if user_data.get("chat_mode") is not True:
+                    # وسط انتظار «پایان چت» زده شده
+                    self.pending.pop(chat_id, None)
+                    return
+                self.stats["calls"] += 1
+                self.stats["coalesced"] += len(batch) - 1
+                # Trace هندلر با برگشتن handle_text بسته شده؛ هر نوبت Gemini Trace خودش رو داره
+                tr = trace_begin("chat_turn", None, chat_id)
+                ok = False
+                try:
+                    await gemini_turn(chat_id, batch[-1][0], "\n".join(t for _, t in batch), user_data)
+                    ok = True
+                except Exception:
+                    logger.exception("Gemini turn failed for chat %s", chat_id)
+                finally:
+                    trace_end(tr, ok)
+                if user_id is not None:
+                    application.mark_data_for_update_persistence(user_ids=user_id)
+        finally:
+            self.tasks.pop(chat_id, None)
+            self.last_at.pop(chat_id, None)
+
+    async def drain(self, timeout: float):
+        if self.tasks:
+            _, pending = await asyncio.wait(list(self.tasks.values()), timeout=timeout)
+            for t in pending:
+                t.cancel()
+
+chat_coalescer = ChatCoalescer()
+
+async def gemini_turn(chat_id: int, message, text: str, user_data: dict):
+    await message.get_bot().send_chat_action(chat_id, ChatAction.TYPING)
+    history = user_data.get("gemini_history") or []
+    summary = user_data.get("gemini_summary")
+    if GEMINI_STREAM:
+        out = await stream_reply(message, gemini_stream(history, text, summary), chat_keyboard)
+    else:
+        out = await gemini_chat(history, text, summary)
+        for part in chunk_text(out):
+            await message.reply_text(part, reply_markup=chat_keyboard)
+    # ذخیره تاریخچه
+    user = message.from_user
+    history_add(user_data, chat_id, text, out, user.id if user else None)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.clear()
@@ -463,45 +2326,46 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
 
     if text in ("/help", "ℹ️ راهنما"):
+        set_branch("help")
         await help_cmd(update, context)
         return
 
     if text == "⬅️ بازگشت":
+        set_branch("back")
         context.user_data.clear()
         await update.message.reply_text("برگشتی به منوی اصلی 👇", reply_markup=main_keyboard)
         return
 
     if text == "❌ لغو":
+        set_branch("cancel")
         context.user_data.clear()
         await update.message.reply_text("✅ لغو شد.", reply_markup=main_keyboard)
         return
 
     if text == "🛑 پایان چت":
+        set_branch("chat_end")
         context.user_data.pop("chat_mode", None)
         context.user_data.pop("gemini_history", None)
+        context.user_data.pop("gemini_summary", None)
+        context.user_data.pop("gemini_overflow", None)
         await update.message.reply_text("✅ چت بسته شد.", reply_markup=main_keyboard)
         return
 
     if context.user_data.get("chat_mode") is True:
-        await context.bot.send_chat_action(chat_id, ChatAction.TYPING)
-        history = context.user_data.get("gemini_history") or []
-        out = await gemini_chat(history, text)
-        # ذخیره تاریخچه
-        history = (history or [])[-12:]
-        history.append({"role": "user", "parts": [{"text": text}]})
-        history.append({"role": "model", "parts": [{"text": out}]})
-        context.user_data["gemini_history"] = history[-12:]
-
-        for part in chunk_text(out):
-            await update.message.reply_text(part, reply_markup=chat_keyboard)
+        set_branch("chat")
+        user = update.effective_user
+        chat_coalescer.submit(chat_id, update.message, text, context.user_data, user.id if user else None)
         return
 
     await context.bot.send_chat_action(chat_id, ChatAction.TYPING)
 
     try:
         if text == "💬 چت‌بات":
+            set_branch("chat_start")
             context.user_data["chat_mode"] = True
             context.user_data["gemini_history"] = []
+            context.user_data.pop("gemini_summary", None)
+            context.user_data.pop("gemini_overflow", None)
             await update.message.reply_text(
                 "💬 چت‌بات Gemini فعال شد.\nبرای خروج: « پایان چت»",
                 reply_markup=chat_keyboard,
@@ -510,25 +2374,57 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
        
         if text == "🛒 دیجی‌کالا":
+            set_branch("dk_menu")
             context.user_data["mode"] = "digikala"
             context.user_data.pop("awaiting", None)
             await update.message.reply_text("🛒 دیجی‌کالا: دسته یا سرچ دستی", reply_markup=digikala_menu_keyboard)
             return
 
         if text == "🔎 سرچ دستی دیجی‌کالا":
+            set_branch("dk_search_prompt")
             context.user_data["mode"] = "digikala"
             context.user_data["awaiting"] = "dk_search_query"
             await update.message.reply_text("چی رو تو دیجی‌کالا سرچ کنم؟", reply_markup=digikala_menu_keyboard)
             return
 
         if context.user_data.get("awaiting") == "dk_search_query":
+            set_branch("dk_search")
             context.user_data.pop("awaiting", None)
             context.user_data["dk_last_query"] = text
             msg, markup = await dk_search(text, page=1)
             await update.message.reply_text(msg, reply_markup=markup or digikala_menu_keyboard)
             return
 
+        if text == "🌐 جستجو در همه‌ی دسته‌ها":
+            set_branch("dk_all_prompt")
+            context.user_data["mode"] = "digikala"
+            context.user_data["awaiting"] = "dk_all_query"
+            await update.message.reply_text("چی رو تو همه‌ی دسته‌ها سرچ کنم؟", reply_markup=digikala_menu_keyboard)
+            return
+
+        if context.user_data.get("awaiting") == "dk_all_query":
+            set_branch("dk_all")
+            context.user_data.pop("awaiting", None)
+            context.user_data["dk_all_query"] = text
+            msg, markup = await dk_search_all(text)
+            await update.message.reply_text(msg, reply_markup=markup or digikala_menu_keyboard)
+            return
+
+        if text == "🔎 جستجوی خودرو":
+            set_branch("car_search_prompt")
+            context.user_data["awaiting"] = "car_search_query"
+            await update.message.reply_text("اسم برند یا مدل خودرو رو بفرست:", reply_markup=main_keyboard)
+            return
+
+        if context.user_data.get("awaiting") == "car_search_query":
+            set_branch("car_search")
+            context.user_data.pop("awaiting", None)
+            for part in chunk_text(await feature_car_search(text)):
+                await update.message.reply_text(part, reply_markup=main_keyboard)
+            return
+
         if text in DIGIKALA_CATS:
+            set_branch("dk_category")
             slug, fa_title = DIGIKALA_CATS[text]
             context.user_data["dk_last_cat"] = (slug, fa_title)
             msg, markup = await dk_category(slug, fa_title, page=1)
@@ -536,21 +2432,29 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         if text == "💵 قیمت ارز":
+            set_branch("fx")
             out = await feature_fx()
         elif text == "🥇 طلا و سکه":
+            set_branch("gold")
             out = await feature_gold()
         elif text == "₿ ارز دیجیتال":
+            set_branch("crypto")
             out = await feature_crypto()
         elif text == "🚗 قیمت خودرو":
+            set_branch("cars")
             out = await feature_cars_all()
         elif text == "📅 مناسبت امروز":
+            set_branch("events")
             out = await feature_today_events()
         elif text == "ℹ️ راهنما":
+            set_branch("help")
             out = HELP_TEXT
         else:
+            set_branch("unknown")
             out = "متوجه نشدم 😅 یکی از دکمه‌ها رو بزن یا «ℹ️ راهنما»."
 
-        for part in chunk_text(out):
+        # فیچرهای لیستی خروجی رندر و chunk شده‌ی کش رو مستقیم برمی‌گردونن
+        for part in out if isinstance(out, list) else chunk_text(out):
             await update.message.reply_text(part, reply_markup=main_keyboard)
 
     except Exception:
@@ -575,6 +2479,16 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await q.message.reply_text(msg, reply_markup=markup or digikala_menu_keyboard)
             return
 
+        if data.startswith("dka_"):
+            _, sort, page_s = data.split("_", 2)
+            last_q = context.user_data.get("dk_all_query")
+            if not last_q or sort not in DK_ALL_SORTS:
+                await q.message.reply_text("اول «🌐 جستجو در همه‌ی دسته‌ها» رو انجام بده.", reply_markup=digikala_menu_keyboard)
+                return
+            msg, markup = await dk_search_all(last_q, sort, int(page_s))
+            await q.message.reply_text(msg, reply_markup=markup or digikala_menu_keyboard)
+            return
+
         if data.startswith("dkc_"):
             _, slug, page_s = data.split("_", 2)
             page = int(page_s)
@@ -590,33 +2504,592 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.exception("Callback error")
         await q.message.reply_text("❌ خطا در صفحه‌بندی.", reply_markup=main_keyboard)
 
-application = ApplicationBuilder().token(TOKEN).build()
-application.add_handler(CommandHandler("start", start))
-application.add_handler(CommandHandler("help", help_cmd))
-application.add_handler(CallbackQueryHandler(handle_callback, pattern=r"^(dks_|dkc_)"))
-application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
+# محدودکننده‌ی ارسال به تلگرام (token bucket): سقف کلی ~30 پیام در ثانیه و سقف
+# جدا برای هر چت (گروه‌ها ۲۰ در دقیقه). روی همه‌ی درخواست‌های Bot API اعمال می‌شه.
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "30"))
+TG_CHAT_RATE = float(os.getenv("TG_CHAT_RATE", "1"))
+TG_CHAT_BURST = 3
+TG_GROUP_RATE = 20 / 60
+TG_MAX_RETRIES = 3
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "ts")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.ts = time.monotonic()
+
+    def reserve(self) -> float:
+        # یک توکن رزرو می‌کنه و زمان انتظار لازم رو برمی‌گردونه (توکن می‌تونه منفی بشه)
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.ts) * self.rate)
+        self.ts = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def idle(self) -> bool:
+        return self.tokens + (time.monotonic() - self.ts) * self.rate >= self.capacity
+
+class _TelegramRateLimiter:
+    # BaseRateLimiter موقع load_telegram() اضافه می‌شه (TelegramRateLimiter)
+    def __init__(self):
+        self._global = TokenBucket(TG_GLOBAL_RATE, TG_GLOBAL_RATE)
+        self._chats: dict[object, TokenBucket] = {}
+        self.stats = {"requests": 0, "delayed": 0, "retry_after": 0}
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        b = self._chats.get(chat_id)
+        if b is None:
+            if len(self._chats) > 10000:
+                self._chats = {k: v for k, v in self._chats.items() if not v.idle()}
+            is_group = isinstance(chat_id, str) or (isinstance(chat_id, int) and chat_id < 0)
+            b = self._chats[chat_id] = (
+                TokenBucket(TG_GROUP_RATE, TG_CHAT_BURST) if is_group else TokenBucket(TG_CHAT_RATE, TG_CHAT_BURST)
+            )
+        return b
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        # span شامل صبر limiter هم هست
+        t0 = time.monotonic()
+        ok = False
+        try:
+            result = await self._process(callback, args, kwargs, endpoint, data, rate_limit_args)
+            ok = True
+            return result
+        finally:
+            trace_span("telegram", endpoint, t0, ok)
+
+    async def _process(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        self.stats["requests"] += 1
+        max_retries = rate_limit_args if rate_limit_args is not None else TG_MAX_RETRIES
+        chat_id = (data or {}).get("chat_id")
+        for attempt in range(max_retries + 1):
+            wait = self._global.reserve()
+            # chat action و answerCallbackQuery فقط سقف کلی رو مصرف می‌کنن
+            if chat_id is not None and endpoint not in ("sendChatAction", "answerCallbackQuery"):
+                wait = max(wait, self._chat_bucket(chat_id).reserve())
+            if wait > 0:
+                self.stats["delayed"] += 1
+                await asyncio.sleep(wait)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == max_retries:
+                    raise
+                self.stats["retry_after"] += 1
+                ra = e.retry_after
+                await asyncio.sleep(ra.total_seconds() if hasattr(ra, "total_seconds") else float(ra))
+
+tg_rate_limiter = None
+
+# وضعیت کاربر (chat_mode، gemini_history، dk_last_*، awaiting) از طریق persistence خود PTB
+# ذخیره می‌شه. بک‌اند SQLite در حالت WAL، با نوشتن دسته‌ای و تأخیری (write-behind).
+# refresh_user_data قبل از هر آپدیت ردیف رو می‌خونه، پس چند پروسه‌ی uvicorn می‌تونن یک
+# فایل رو شریک باشن؛ اگه دو پروسه همزمان یک کاربر رو تغییر بدن، آخرین نوشتن برنده‌ست.
+STATE_BACKEND = (os.getenv("STATE_BACKEND") or "sqlite").strip()  # sqlite | memory
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "bot_state.sqlite3")
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", "2"))
+
+class _SQLitePersistence:
+    # BasePersistence موقع load_telegram() اضافه می‌شه (SQLitePersistence)
+    def __init__(self, path: str, update_interval: float):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.path = path
+        self._db: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+        self._versions: dict[int, int] = {}
+        self._pending: dict[int, str | None] = {}
+        self._flush_task: asyncio.Task | None = None
+
+    def _conn(self) -> sqlite3.Connection:
+        if self._db is None:
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS user_state ("
+                "user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, version INTEGER NOT NULL DEFAULT 1)"
+            )
+            self._db = db
+        return self._db
+
+    def _read(self, user_id: int):
+        with self._lock:
+            return self._conn().execute(
+                "SELECT version, data FROM user_state WHERE user_id = ?", (user_id,)
+            ).fetchone()
+
+    def _write(self, rows: list) -> dict[int, int]:
+        versions = {}
+        with self._lock:
+            db = self._conn()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                for user_id, data in rows:
+                    if data is None:
+                        db.execute("DELETE FROM user_state WHERE user_id = ?", (user_id,))
+                        versions[user_id] = 0
+                    else:
+                        versions[user_id] = db.execute(
+                            "INSERT INTO user_state (user_id, data) VALUES (?, ?) "
+                            "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, version = version + 1 "
+                            "RETURNING version",
+                            (user_id, data),
+                        ).fetchone()[0]
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+        return versions
+
+    def _schedule_flush(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_pending())
+
+    async def _flush_pending(self):
+        # یک دور صبر تا همه‌ی update_user_data های همین نوبت جمع بشن و با یک تراکنش برن
+        await asyncio.sleep(0)
+        while self._pending:
+            rows = list(self._pending.items())
+            self._pending.clear()
+            try:
+                self._versions.update(await asyncio.to_thread(self._write, rows))
+            except Exception:
+                logger.exception("State flush failed")
+                for user_id, data in rows:
+                    self._pending.setdefault(user_id, data)
+                return
+
+    async def get_user_data(self) -> dict:
+        # lazy: هر کاربر موقع اولین آپدیتش با refresh_user_data لود می‌شه
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        if user_id in self._pending:
+            return
+        row = await asyncio.to_thread(self._read, user_id)
+        if row and row[0] != self._versions.get(user_id):
+            self._versions[user_id] = row[0]
+            user_data.clear()
+            user_data.update(json.loads(row[1]))
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._pending[user_id] = json.dumps(data, ensure_ascii=False, default=str)
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._pending[user_id] = None
+        self._schedule_flush()
+
+    async def flush(self) -> None:
+        if self._flush_task:
+            await self._flush_task
+        await self._flush_pending()
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        pass
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+STATE_BACKENDS = {
+    "sqlite": lambda: SQLitePersistence(STATE_DB_PATH, STATE_FLUSH_INTERVAL),
+    "memory": lambda: None,
+}
+
+# برچسب متریک/Trace برای هر آپدیت؛ handler می‌تونه شاخه‌ای که واقعاً رفته رو با set_branch بگه
+_branch: contextvars.ContextVar = contextvars.ContextVar("branch", default=None)
+
+def set_branch(label: str):
+    box = _branch.get()
+    if box is not None:
+        box[0] = label
+    tr = _current_trace.get()
+    if tr is not None:
+        tr.label = label
+
+def callback_branch(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
+    data = (update.callback_query and update.callback_query.data) or ""
+    return "cb_" + data.split("_", 1)[0] if "_" in data else "cb_unknown"
+
+def timed(fn, label):
+    @functools.wraps(fn)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        box = [label(update, context) if callable(label) else label]
+        token = _branch.set(box)
+        t0 = time.monotonic()
+        chat = update.effective_chat if isinstance(update, Update) else None
+        tr = trace_begin(box[0], getattr(update, "update_id", None), chat.id if chat else None)
+        ok = False
+        try:
+            result = await fn(update, context)
+            ok = True
+            return result
+        finally:
+            handler_seconds.observe(time.monotonic() - t0, box[0])
+            trace_end(tr, ok)
+            _branch.reset(token)
+    return wrapper
+
+_telegram_loaded = False
+
+def load_telegram():
+    global _telegram_loaded, httpx, Update, ReplyKeyboardMarkup, InlineKeyboardMarkup, InlineKeyboardButton
+    global InlineQueryResultArticle, InputTextMessageContent, ChatAction, TelegramError, RetryAfter, HTTPXRequest
+    global ApplicationBuilder, BaseRateLimiter, BasePersistence, PersistenceInput, CommandHandler, MessageHandler
+    global CallbackQueryHandler, InlineQueryHandler, ContextTypes, filters
+    global main_keyboard, digikala_menu_keyboard, chat_keyboard, TelegramRateLimiter, SQLitePersistence, tg_rate_limiter
+    if _telegram_loaded:
+        return
+    import httpx
+    from telegram import (
+        Update,
+        ReplyKeyboardMarkup,
+        InlineKeyboardMarkup,
+        InlineKeyboardButton,
+        InlineQueryResultArticle,
+        InputTextMessageContent,
+    )
+    from telegram.constants import ChatAction
+    from telegram.error import TelegramError, RetryAfter
+    from telegram.request import HTTPXRequest
+    from telegram.ext import (
+        ApplicationBuilder,
+        BaseRateLimiter,
+        BasePersistence,
+        PersistenceInput,
+        CommandHandler,
+        MessageHandler,
+        CallbackQueryHandler,
+        InlineQueryHandler,
+        ContextTypes,
+        filters,
+    )
+
+    main_keyboard = ReplyKeyboardMarkup(MAIN_KEYBOARD, resize_keyboard=True)
+    digikala_menu_keyboard = ReplyKeyboardMarkup(DIGIKALA_MENU_KEYBOARD, resize_keyboard=True)
+    chat_keyboard = ReplyKeyboardMarkup(CHAT_KEYBOARD, resize_keyboard=True)
+    TelegramRateLimiter = type("TelegramRateLimiter", (_TelegramRateLimiter, BaseRateLimiter), {})
+    SQLitePersistence = type("SQLitePersistence", (_SQLitePersistence, BasePersistence), {})
+    tg_rate_limiter = TelegramRateLimiter()
+    _telegram_loaded = True
+
+def build_application(request=None, application_class=None):
+    load_telegram()
+    # request / application_class فقط برای bench.py (Bot API ساختگی و زمان‌سنجی آپدیت‌ها)
+    builder = ApplicationBuilder().token(TOKEN).rate_limiter(tg_rate_limiter)
+    persistence = STATE_BACKENDS[STATE_BACKEND]()
+    if persistence is not None:
+        builder = builder.persistence(persistence)
+    # webhook هیچ‌وقت getUpdates نمی‌زنه؛ یک request مشترک یعنی یک SSL context کمتر موقع بوت
+    request = request or HTTPXRequest(connection_pool_size=256)
+    builder = builder.request(request).get_updates_request(request)
+    if application_class is not None:
+        builder = builder.application_class(application_class)
+    app = builder.build()
+    app.add_handler(CommandHandler("start", timed(start, "start")))
+    app.add_handler(CommandHandler("help", timed(help_cmd, "help")))
+    app.add_handler(CommandHandler("alert", timed(alert_cmd, "alert")))
+    app.add_handler(CommandHandler("alerts", timed(alerts_cmd, "alerts")))
+    app.add_handler(CommandHandler("unalert", timed(unalert_cmd, "unalert")))
+    app.add_handler(CallbackQueryHandler(timed(handle_callback, callback_branch), pattern=r"^(dks_|dkc_|dka_)"))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, timed(handle_text, "unknown")))
+    app.add_handler(InlineQueryHandler(timed(inline_cars, "inline_cars")))
+    return app
+
+# تو boot() ساخته می‌شه (یا bench.py قبل از lifespan خودش می‌سازه)
+application = None
+
+# Webhook فقط آپدیت رو صف می‌کنه و سریع 200 برمی‌گردونه؛ یک pool از workerها
+# صف رو خالی می‌کنن. آپدیت‌های یک چت به ترتیب، چت‌های مختلف موازی پردازش می‌شن.
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "8"))
+UPDATE_QUEUE_MAX = int(os.getenv("UPDATE_QUEUE_MAX", "1000"))
+
+# موقع خاموش شدن: اول ورودی بسته می‌شه (503)، بعد صف تا SHUTDOWN_DEADLINE خالی می‌شه
+SHUTDOWN_DEADLINE = float(os.getenv("SHUTDOWN_DEADLINE", "20"))
+
+_upd_pending: dict[object, deque] = {}
+_upd_ready: asyncio.Queue | None = None
+_upd_accepting = False
+_upd_workers: list[asyncio.Task] = []
+update_stats = {"depth": 0, "busy": 0, "accepted": 0, "processed": 0, "shed": 0, "duplicate": 0}
+
+# پنجره‌ی update_idهای اخیر (حافظه ثابت): تکرارهای تلگرام قبل از هر کاری دور ریخته می‌شن
+UPDATE_DEDUP_WINDOW = int(os.getenv("UPDATE_DEDUP_WINDOW", "4096"))
+
+_seen_ids: set[int] = set()
+_seen_ring: deque = deque()
+
+def mark_update_seen(update_id: int):
+    if len(_seen_ring) >= UPDATE_DEDUP_WINDOW:
+        _seen_ids.discard(_seen_ring.popleft())
+    _seen_ring.append(update_id)
+    _seen_ids.add(update_id)
+
+def _update_chat_key(update: Update):
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        return ("user", update.effective_user.id)
+    return ("update", update.update_id)
+
+def enqueue_update(update: Update) -> bool:
+    if not _upd_accepting or _upd_ready is None or update_stats["depth"] >= UPDATE_QUEUE_MAX:
+        update_stats["shed"] += 1
+        return False
+    key = _update_chat_key(update)
+    q = _upd_pending.get(key)
+    if q is None:
+        # چت جدید → آماده برای یک worker؛ وگرنه worker فعلی همین چت اون رو برمی‌داره
+        _upd_pending[key] = deque([update])
+        _upd_ready.put_nowait(key)
+    else:
+        q.append(update)
+    update_stats["depth"] += 1
+    update_stats["accepted"] += 1
+    return True
+
+async def _update_worker():
+    while True:
+        key = await _upd_ready.get()
+        q = _upd_pending[key]
+        update_stats["busy"] += 1
+        try:
+            while q:
+                try:
+                    await application.process_update(q[0])
+                except Exception:
+                    logger.exception("Update processing failed")
+                finally:
+                    q.popleft()
+                    update_stats["depth"] -= 1
+                    update_stats["processed"] += 1
+        finally:
+            update_stats["busy"] -= 1
+            _upd_pending.pop(key, None)
+
+def start_update_workers():
+    global _upd_ready, _upd_accepting
+    _upd_ready = asyncio.Queue()
+    _upd_accepting = True
+    for i in range(UPDATE_WORKERS):
+        _upd_workers.append(asyncio.create_task(_update_worker(), name=f"update-worker-{i}"))
+
+async def stop_update_workers(deadline: float = 0.0):
+    global _upd_ready, _upd_accepting
+    _upd_accepting = False
+    end = time.monotonic() + deadline
+    while update_stats["depth"] and time.monotonic() < end:
+        await asyncio.sleep(0.05)
+    if update_stats["depth"]:
+        logger.warning("Drain deadline hit; dropping %d queued updates", update_stats["depth"])
+    _upd_ready = None
+    for t in _upd_workers:
+        t.cancel()
+    await asyncio.gather(*_upd_workers, return_exceptions=True)
+    _upd_workers.clear()
+    _upd_pending.clear()
+    update_stats["depth"] = 0
 
 async def telegram_webhook(request: Request):
+    if not _boot_ready.is_set():
+        try:
+            await asyncio.wait_for(_boot_ready.wait(), BOOT_WAIT)
+        except asyncio.TimeoutError:
+            return Response("starting", status_code=503, headers={"Retry-After": "5"})
     data = await request.json()
+    update_id = data.get("update_id") if isinstance(data, dict) else None
+    # از اینجا تا mark_update_seen هیچ await نیست، پس بین درخواست‌های همزمان هم درسته
+    if update_id in _seen_ids:
+        update_stats["duplicate"] += 1
+        return Response("ok")
     update = Update.de_json(data, application.bot)
-    await application.process_update(update)
+    if not enqueue_update(update):
+        # 503 → تلگرام بعداً دوباره می‌فرسته؛ آپدیت گم نمی‌شه
+        return Response("busy", status_code=503, headers={"Retry-After": "5"})
+    if update_id is not None:
+        mark_update_seen(update_id)
     return Response("ok")
 
+async def queue_stats(_: Request):
+    return JSONResponse({**update_stats, "workers": UPDATE_WORKERS, "max": UPDATE_QUEUE_MAX})
+
+async def stats(_: Request):
+    return JSONResponse({
+        "updates": {**update_stats, "workers": UPDATE_WORKERS, "max": UPDATE_QUEUE_MAX},
+        "dk_cache": {**dk_cache_stats, "size": len(_dk_cache), "max": DK_CACHE_MAX},
+        "telegram_limiter": tg_rate_limiter.stats if tg_rate_limiter else None,
+        "upstreams": {
+            host: {"state": b.state, "failures": b.failures, "p95_ms": round((host_p95(host) or 0) * 1000, 1)}
+            for host, b in _breakers.items()
+        },
+        "hedge": hedge_stats,
+        "http_pools": http_pool_stats(),
+        "gemini_gate": {"active": gemini_gate.active, "waiting": len(gemini_gate._waiters), "limit": gemini_gate.limit},
+        "alerts": {**alert_engine.stats, "active": len(alert_engine.subs)},
+        "boot_ms": boot_timings,
+        "traces": trace_stats,
+        "render_cache": {**render_stats, "size": len(_render_cache)},
+        "checkpoint": {**checkpoint_stats, "lazy_pending": len(_dk_lazy)},
+        "gemini_coalescer": {**chat_coalescer.stats, "active_chats": len(chat_coalescer.tasks)},
+    })
+
+async def metrics(_: Request):
+    out = []
+    for m in (handler_seconds, upstream_seconds, upstream_requests, upstream_errors, gemini_tokens):
+        m.render(out)
+    out.append("# HELP bot_updates_inflight Updates being processed right now.\n# TYPE bot_updates_inflight gauge")
+    out.append(f"bot_updates_inflight {update_stats['busy']}")
+    out.append("# HELP bot_update_queue_depth Updates accepted but not finished.\n# TYPE bot_update_queue_depth gauge")
+    out.append(f"bot_update_queue_depth {update_stats['depth']}")
+    out.append("# HELP bot_updates_total Webhook updates by outcome.\n# TYPE bot_updates_total counter")
+    for k in ("accepted", "processed", "shed", "duplicate"):
+        out.append(f'bot_updates_total{{outcome="{k}"}} {update_stats[k]}')
+    return PlainTextResponse("\n".join(out) + "\n", media_type="text/plain; version=0.0.4")
+
 async def ping(_: Request):
     return PlainTextResponse("pong")
 
+# بوت سریع: lifespan بلافاصله yield می‌کنه تا پورت باز بشه و /ping جواب بده؛ کارهای
+# سنگین (ساخت Application، getMe، گرم کردن poolها) تو پس‌زمینه انجام می‌شه و /telegram
+# تا آماده شدنش صبر می‌کنه. زمان هر مرحله تو boot_timings (و /stats) ثبت می‌شه.
+BOOT_BACKGROUND = os.getenv("BOOT_BACKGROUND", "1") != "0"
+BOOT_WAIT = float(os.getenv("BOOT_WAIT", "25"))
+BOOT_BUDGET_MS = float(os.getenv("BOOT_BUDGET_MS", "1500"))
+
+boot_timings: dict[str, float] = {}
+_boot_ready = asyncio.Event()
+
+class _BootClock:
+    def __init__(self):
+        self.t = time.perf_counter()
+
+    def __call__(self, phase: str):
+        now = time.perf_counter()
+        boot_timings[phase] = round((now - self.t) * 1000, 1)
+        self.t = now
+
+def boot_local(clock: _BootClock):
+    # مراحل بدون شبکه؛ همین‌ها تو --boot-budget اندازه گرفته می‌شن
+    global application
+    load_telegram()
+    clock("import_telegram")
+    load_price_history()
+    clock("price_history")
+    load_holiday_calendar()
+    clock("holiday_calendar")
+    load_checkpoint()
+    clock("checkpoint")
+    if application is None:
+        application = build_application()
+    clock("build_application")
+
+async def boot():
+    t0 = time.perf_counter()
+    clock = _BootClock()
+    # import سنگین تو thread تا /ping وسطش جواب بده
+    await asyncio.to_thread(load_telegram)
+    boot_local(clock)
+    await asyncio.gather(application.initialize(), warm_http_pools())
+    clock("initialize+warm_http")
+    await application.start()
+    if PREFETCH_ENABLED:
+        schedule_prefetch(application)
+    if application.job_queue is not None:
+        application.job_queue.run_repeating(history_dump_job, interval=600, first=600, name="history-dump")
+        application.job_queue.run_repeating(
+            checkpoint_job, interval=CHECKPOINT_INTERVAL, first=CHECKPOINT_INTERVAL, name="checkpoint"
+        )
+        application.job_queue.run_daily(holiday_rollover_job, dtime(0, 0, 5, tzinfo=TEHRAN_TZ), name="holiday-rollover")
+    schedule_holiday_fill()
+    await alert_engine.sync()
+    start_update_workers()
+    clock("start")
+    boot_timings["total"] = round((time.perf_counter() - t0) * 1000, 1)
+    _boot_ready.set()
+    logger.info("Bot started in %.0f ms: %s", boot_timings["total"], boot_timings)
+
+async def _boot_or_exit():
+    try:
+        await boot()
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        # مثل قبل که خطای startup پروسه رو می‌خوابوند: uvicorn خاموش می‌شه و پلتفرم ری‌استارت می‌کنه
+        logger.exception("Boot failed")
+        import signal
+        os.kill(os.getpid(), signal.SIGTERM)
+
 @asynccontextmanager
 async def lifespan(app: Starlette):
-    await application.initialize()
-    await application.start()
-    logger.info("Bot started")
+    global _boot_ready
+    _boot_ready = asyncio.Event()
+    boot_task = asyncio.create_task(_boot_or_exit())
+    if not BOOT_BACKGROUND:
+        await boot_task
     yield
-    await application.stop()
-    await application.shutdown()
-    global _http
-    if _http:
-        await _http.aclose()
-        _http = None
+    if not boot_task.done():
+        boot_task.cancel()
+        await asyncio.gather(boot_task, return_exceptions=True)
+    end = time.monotonic() + SHUTDOWN_DEADLINE
+    await stop_update_workers(SHUTDOWN_DEADLINE)
+    await chat_coalescer.drain(max(1.0, end - time.monotonic()))
+    if application is not None:
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+    try:
+        dump_price_history()
+    except Exception:
+        logger.exception("Price history dump failed")
+    try:
+        checkpoint_now()
+    except Exception:
+        logger.exception("Final checkpoint failed")
+    await close_http_pools()
+    await flush_traces()
     logger.info("Bot stopped")
 
 starlette_app = Starlette(
@@ -624,12 +3097,64 @@ starlette_app = Starlette(
     routes=[
         Route("/telegram", telegram_webhook, methods=["POST"]),
         Route("/ping", ping, methods=["GET"]),
+        Route("/queue", queue_stats, methods=["GET"]),
+        Route("/stats", stats, methods=["GET"]),
+        Route("/metrics", metrics, methods=["GET"]),
     ],
 )
 
+def boot_report(budget_ms: float | None) -> int:
+    # زمان import (با -X importtime تو یک پروسه‌ی تازه، به تفکیک importهای سطح اول) + مراحل
+    # محلی بوت. مراحل شبکه (getMe، warm-up) اینجا اجرا نمی‌شن؛ زمان واقعی‌شون تو لاگ بوت هست.
+    import sys
+    import subprocess
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = {**os.environ, "PYTHONPATH": here}
+    r = subprocess.run([sys.executable, "-X", "importtime", "-c", "import bot"],
+                       cwd=here, env=env, capture_output=True, text=True, check=True)
+    rows, total = [], 0.0
+    for line in r.stderr.splitlines():
+        m = re.match(r"import time:\s*(\d+) \|\s*(\d+) \| (\s*)(\S+)", line)
+        if not m:
+            continue
+        depth = len(m.group(3)) // 2
+        if depth == 0 and m.group(4) == "bot":
+            total = int(m.group(2)) / 1000
+            rows.append(("bot (module body)", int(m.group(1)) / 1000))
+        elif depth == 1:
+            rows.append((m.group(4), int(m.group(2)) / 1000))
+
+    clock = _BootClock()
+    boot_local(clock)
+    local = sum(boot_timings.values())
+
+    print(f"{'import':<40}{'ms':>10}")
+    for name, ms in sorted(rows, key=lambda x: -x[1])[:15]:
+        print(f"  {name:<38}{ms:>10.1f}")
+    print(f"{'boot (local phases)':<40}{'ms':>10}")
+    for name, ms in boot_timings.items():
+        print(f"  {name:<38}{ms:>10.1f}")
+    total += local
+    print(f"{'total':<40}{total:>10.1f}")
+    if budget_ms is not None and total > budget_ms:
+        print(f"FAIL: boot {total:.0f} ms > budget {budget_ms:.0f} ms")
+        return 1
+    if budget_ms is not None:
+        print(f"OK: boot {total:.0f} ms <= budget {budget_ms:.0f} ms")
+    return 0
+
 if __name__ == "__main__":
+    import sys
+
     if not TOKEN:
         raise RuntimeError("TOKEN env var is missing")
+    if "--profile-boot" in sys.argv:
+        sys.exit(boot_report(None))
+    if "--boot-budget" in sys.argv:
+        sys.exit(boot_report(BOOT_BUDGET_MS))
+    import uvicorn
+
     uvicorn.run(starlette_app, host="0.0.0.0", port=PORT, log_level="info")
 
 